@@ -1,12 +1,24 @@
 import logging
+import logging.handlers
+import atexit
+import contextvars
+import queue
 import datetime
 import asyncio
 import uuid
 import os
+import sys
+import threading
+from collections import Counter, OrderedDict, deque
+import json
+import html
+import math
+import time
+from zoneinfo import ZoneInfo
 import psycopg2
-from psycopg2.extras import DictCursor
+from psycopg2.extras import DictCursor, Json, execute_values
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove, BotCommand, InputMediaPhoto
+from telegram import Update, Message, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove, BotCommand, InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio, InputFile
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -14,9 +26,11 @@ from telegram.ext import (
     MessageHandler,
     filters,
     ConversationHandler,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    BasePersistence,
+    PersistenceInput
 )
-from telegram.constants import ParseMode, ChatAction
+from telegram.constants import ParseMode
 from telegram.error import Forbidden, BadRequest
 from functools import wraps
 
@@ -33,88 +47,595 @@ FORBIDDEN_CHARS = {'и', 'щ', 'ъ', 'И', 'Щ', 'Ъ'}
 WARNING_LIMIT = 3
 AMNESTY_CODE = "АДРАДЖЭННЕ"
 
+# --- Настройки персистентности (user_data и состояния ConversationHandler) ---
+PERSISTENCE_UPDATE_INTERVAL = int(os.getenv("PERSISTENCE_UPDATE_INTERVAL", "30"))
+PERSISTENCE_IDLE_TTL = int(os.getenv("PERSISTENCE_IDLE_TTL", "1800"))
+
+# --- Настройки доказательств к жалобам ---
+REPORT_TRANSCRIPT_LIMIT = int(os.getenv("REPORT_TRANSCRIPT_LIMIT", "50"))
+
+# --- Настройки поиска по гісторыі ---
+TEXT_SEARCH_PAGE_SIZE = 10
+TEXT_SEARCH_SAVED_QUERIES = 5
+
+# --- Настройки пересылки альбомов ---
+MEDIA_GROUP_WINDOW = float(os.getenv("MEDIA_GROUP_WINDOW", "0.8"))
+MEDIA_GROUP_MAX_SIZE = 10
+
+# --- Настройки пересылки правок ---
+EDIT_DEBOUNCE_WINDOW = float(os.getenv("EDIT_DEBOUNCE_WINDOW", "1.5"))
+EDIT_LOG_FLUSH_INTERVAL = float(os.getenv("EDIT_LOG_FLUSH_INTERVAL", "5"))
+RELAYED_MESSAGES_CACHE_SIZE = 10000
+
+# --- Таймауты неактивности (0 отключает) ---
+CHAT_IDLE_TIMEOUT = int(os.getenv("CHAT_IDLE_TIMEOUT", "1800"))
+SEARCH_TIMEOUT = int(os.getenv("SEARCH_TIMEOUT", "600"))
+TIMER_WHEEL_TICK = float(os.getenv("TIMER_WHEEL_TICK", "5"))
+
+# --- Настройки профилировщика и сторожа event loop ---
+PROFILER_DEFAULT_SECONDS = 30
+PROFILER_MAX_SECONDS = 300
+PROFILER_SAMPLE_INTERVAL = 0.01
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.5"))
+
+# --- Настройки работы без БД (журнал отложенных записей и предохранитель) ---
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "3"))
+# Подключения из event loop блокируют его целиком, поэтому ждём меньше (2 с — минимум libpq)
+DB_LOOP_CONNECT_TIMEOUT = int(os.getenv("DB_LOOP_CONNECT_TIMEOUT", "2"))
+DB_SPOOL_PATH = os.getenv("DB_SPOOL_PATH", "db_spool.jsonl")
+DB_SPOOL_SYNC_INTERVAL = float(os.getenv("DB_SPOOL_SYNC_INTERVAL", "1"))
+DB_BREAKER_THRESHOLD = 3
+DB_BREAKER_COOLDOWN = 2.0
+DB_BREAKER_MAX_COOLDOWN = 30.0
+
+# --- Настройки реплики для чтения (админка и аналитика; без DATABASE_REPLICA_URL всё читается с первичной БД) ---
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "30"))
+REPLICA_LAG_CHECK_INTERVAL = 10
+
+# --- Настройки аналитических сводок ---
+ROLLUP_INTERVAL = int(os.getenv("ROLLUP_INTERVAL", "300"))
+ROLLUP_BATCH_SIZE = 50000
+ROLLUP_TIMEZONE = os.getenv("ROLLUP_TIMEZONE", "Europe/Minsk")
+# Чат завершается по chat_sessions.ended_at. Чаты без него (история, сброс после рестарта) считаются
+# завершёнными, если столько секунд нет сообщений и чат уже ни у кого не текущий.
+ROLLUP_SESSION_SETTLE = CHAT_IDLE_TIMEOUT or 3600
+ROLLUP_HISTOGRAMS = {
+    'session_seconds': [60, 300, 900, 1800, 3600],
+    'session_messages': [2, 5, 10, 25, 50, 100],
+    'wait_seconds': [5, 30, 60, 300, 600],
+}
+TRENDS_DEFAULT_WEEKS = 8
+TRENDS_MAX_WEEKS = 52
+
 # Состояния для ConversationHandlers
 (AWAITING_BROADCAST_MESSAGE, AWAITING_INFO_ID, AWAITING_SENDTO_IDS, AWAITING_SENDTO_MESSAGE, AWAITING_REPORT_SCREENSHOTS) = range(5)
 CHAT_STATUS_IDLE, CHAT_STATUS_WAITING, CHAT_STATUS_CHATTING = "idle", "waiting", "chatting"
 
-logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+# --- ЛОГИРОВАНИЕ ---
+# Хендлеры только кладут запись в очередь; форматирование и запись в поток идут в фоновом потоке
+# QueueListener. Повторяющиеся предупреждения и ошибки (один и тот же шаблон) ограничиваются
+# LOG_RATE_LIMIT за окно; INFO (регистрации, блокировки бота и т.п.) не прореживается.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", "20"))
+LOG_RATE_WINDOW = float(os.getenv("LOG_RATE_WINDOW", "60"))
+LOG_CONTEXT_FIELDS = ('user_id', 'session_id', 'handler')
+
+log_context: contextvars.ContextVar[dict] = contextvars.ContextVar("log_context", default={})
+
+class LogContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = log_context.get()
+        for field in LOG_CONTEXT_FIELDS:
+            setattr(record, field, context.get(field))
+        return True
+
+class LogRateLimitFilter(logging.Filter):
+    def __init__(self, limit: int = LOG_RATE_LIMIT, window: float = LOG_RATE_WINDOW):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self._windows: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not self.limit or record.levelno < logging.WARNING: return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.window:
+                if len(self._windows) > 1000:
+                    self._windows = {k: w for k, w in self._windows.items() if now - w[0] < self.window}
+                record.suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+                return True
+            window[1] += 1
+            if window[1] <= self.limit:
+                record.suppressed = 0
+                return True
+            window[2] += 1
+            return False
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # Стандартный QueueHandler.prepare() форматирует сообщение в вызывающем потоке (то есть в event loop)
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+class TextLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        context = " ".join(f"{field}={getattr(record, field)}" for field in LOG_CONTEXT_FIELDS if getattr(record, field, None))
+        if context: line += f" [{context}]"
+        if getattr(record, 'suppressed', 0): line += f" (+{record.suppressed} паўтораў прапушчана)"
+        return line
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'ts': self.formatTime(record), 'level': record.levelname, 'logger': record.name, 'msg': record.getMessage()}
+        for field in LOG_CONTEXT_FIELDS:
+            if getattr(record, field, None): entry[field] = getattr(record, field)
+        if getattr(record, 'suppressed', 0): entry['suppressed'] = record.suppressed
+        if record.exc_info: entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_logging() -> logging.handlers.QueueListener:
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonLogFormatter() if LOG_FORMAT == "json" else TextLogFormatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(LogRateLimitFilter())
+    queue_handler.addFilter(LogContextFilter())
+    root_logger = logging.getLogger()
+    root_logger.handlers[:] = [queue_handler]
+    root_logger.setLevel(logging.INFO)
+    # httpx пишет INFO на каждый запрос к Bot API, apscheduler — по две строки на каждый запуск задачи
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("apscheduler").setLevel(logging.WARNING)
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
 # --- КЛАВИАТУРЫ ---
 ADMIN_MAIN_MENU_KEYBOARD = ReplyKeyboardMarkup([["📊 Статыстыка", "👥 Карыстальнікі"],["📣 Рассылкі", "💬 Выпадковы чат"],["🆘 SOS-чаты", "⚙️ Сыстэма"]], resize_keyboard=True)
 ADMIN_USERS_MENU_KEYBOARD = ReplyKeyboardMarkup([["ℹ️ Інфо пра юзэра", "📋 Сьпіс усіх"],["🔙 Галоўнае мэню"]], resize_keyboard=True)
 ADMIN_BROADCAST_MENU_KEYBOARD = ReplyKeyboardMarkup([["📣 Усім", "🎯 Выбраным"],["🔙 Галоўнае мэню"]], resize_keyboard=True)
-ADMIN_SYSTEM_MENU_KEYBOARD = ReplyKeyboardMarkup([["🗑️ Ачысьціць гісторыю чатаў"],["🔙 Галоўнае мэню"]], resize_keyboard=True)
-
+ADMIN_SYSTEM_MENU_KEYBOARD = ReplyKeyboardMarkup([["🗑️ Ачысьціць гісторыю чатаў"],["🔬 Прафіляваньне"],["🔙 Галоўнае мэню"]], resize_keyboard=True)
+
+
+# --- РАБОТА БЕЗ БД: ПРЕДОХРАНИТЕЛЬ И ЖУРНАЛ ОТЛОЖЕННЫХ ЗАПИСЕЙ ---
+
+class DatabaseUnavailable(psycopg2.OperationalError):
+    pass
+
+# Ошибки, после которых запись уходит в журнал, а чтение — в кэш, вместо падения хендлера.
+# OperationalError шире потери связи (deadlock, отмена запроса, DiskFull), поэтому перехваченное
+# дополнительно проверяется is_connection_lost, а остальное пробрасывается дальше.
+DB_CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+# admin_shutdown, crash_shutdown, cannot_connect_now: сервер разорвал соединение или ещё не принимает их
+DB_DISCONNECT_SQLSTATES = {'57P01', '57P02', '57P03'}
+
+def is_connection_lost(e: psycopg2.Error) -> bool:
+    # Без SQLSTATE ошибку выдал сам libpq: не удалось подключиться или соединение оборвалось
+    return e.pgcode is None or e.pgcode.startswith('08') or e.pgcode in DB_DISCONNECT_SQLSTATES
+
+class CircuitBreaker:
+    # После threshold неудачных подключений подряд обращения к БД сразу отклоняются на cooldown секунд;
+    # затем пропускается одно пробное, и при новой неудаче пауза удваивается до max_cooldown.
+    # Пробуют только вызовы из to_thread (probe=True): хендлеры в event loop при разомкнутом
+    # предохранителе сразу получают отказ, а их собственная неудача размыкает его без порога (trip=True).
+    # Вызывается и из event loop, и из to_thread, поэтому под threading.Lock.
+
+    def __init__(self, name: str = "БД", threshold: int = DB_BREAKER_THRESHOLD, cooldown: float = DB_BREAKER_COOLDOWN, max_cooldown: float = DB_BREAKER_MAX_COOLDOWN):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._failures = 0
+        self._current_cooldown = cooldown
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._failures >= self.threshold
+
+    def allow_request(self, probe: bool = True) -> bool:
+        with self._lock:
+            if self._failures < self.threshold: return True
+            if not probe: return False
+            now = time.monotonic()
+            if now < self._open_until: return False
+            self._open_until = now + self._current_cooldown
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._failures >= self.threshold:
+                logger.info("%s снова доступна после %s неудачных подключений.", self.name, self._failures)
+            self._failures = 0
+            self._current_cooldown = self.cooldown
+
+    def record_failure(self, trip: bool = False):
+        with self._lock:
+            self._failures = max(self._failures + 1, self.threshold) if trip else self._failures + 1
+            if self._failures < self.threshold: return
+            if self._failures == self.threshold:
+                logger.error("%s недоступна, обращения приостановлены на %.0f с.", self.name, self._current_cooldown)
+            else:
+                self._current_cooldown = min(self._current_cooldown * 2, self.max_cooldown)
+            self._open_until = time.monotonic() + self._current_cooldown
+
+class WriteSpool:
+    # Журнал записей, которые не удалось сделать в БД: одна JSON-строка на вызов, только дозапись.
+    # fsync делается пачкой раз в DB_SPOOL_SYNC_INTERVAL (db_spool_job), а не на каждую строку.
+    # Пока журнал не перенесён в БД, новые записи тоже идут в него, чтобы не нарушить порядок.
+    # Перенос забирает файл целиком (переименование в .replay), новые записи тем временем идут в свежий.
+
+    def __init__(self, path: str):
+        self.path = path
+        self.replay_path = path + ".replay"
+        self._file = None
+        self._unsynced = False
+        self._lock = threading.Lock()
+        self.pending = self._count_lines(path)
+        self._replay_pending = os.path.exists(self.replay_path)
+
+    @staticmethod
+    def _count_lines(path: str) -> int:
+        if not os.path.exists(path): return 0
+        with open(path, encoding="utf-8") as f:
+            return sum(1 for _ in f)
+
+    @property
+    def active(self) -> bool:
+        return bool(self.pending) or self._replay_pending
+
+    @property
+    def needs_sync(self) -> bool:
+        return self._unsynced
+
+    def append(self, kind: str, rows: list):
+        line = json.dumps({'kind': kind, 'rows': rows}, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a+", encoding="utf-8")
+                # Оборванная при падении последняя строка не должна склеиться с новой
+                if self._file.tell():
+                    self._file.seek(self._file.tell() - 1)
+                    if self._file.read(1) != "\n": self._file.write("\n")
+            self._file.write(line)
+            self.pending += 1
+            self._unsynced = True
+
+    def _sync_locked(self):
+        if self._file and self._unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unsynced = False
+
+    def sync(self):
+        with self._lock:
+            self._sync_locked()
+
+    def close(self):
+        with self._lock:
+            self._sync_locked()
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def take_for_replay(self) -> list[dict]:
+        with self._lock:
+            # Файл, перенос которого прервался, повторяется первым, иначе забирается текущий журнал
+            if not self._replay_pending:
+                if not self.pending: return []
+                self._sync_locked()
+                if self._file:
+                    self._file.close()
+                    self._file = None
+                os.replace(self.path, self.replay_path)
+                self.pending = 0
+                self._replay_pending = True
+        entries = []
+        with open(self.replay_path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip(): continue
+                try: entries.append(json.loads(line))
+                except json.JSONDecodeError: logger.warning("Пропущена повреждённая строка журнала %s", self.replay_path)
+        return entries
+
+    def finish_replay(self, failed: bool = False, rejected: dict[str, list] | None = None):
+        with self._lock:
+            failed_path = f"{self.replay_path}.failed.{int(time.time())}"
+            if failed:
+                # Записи, которые БД отвергает не из-за связи, не должны навсегда заблокировать журнал
+                os.replace(self.replay_path, failed_path)
+            else:
+                if rejected:
+                    # Отвергнутые при переносе строки откладываются в сторону, остальные уже в БД
+                    with open(failed_path, "a", encoding="utf-8") as f:
+                        for kind, rows in rejected.items():
+                            f.write(json.dumps({'kind': kind, 'rows': rows}, ensure_ascii=False, default=str) + "\n")
+                        f.flush()
+                        os.fsync(f.fileno())
+                os.remove(self.replay_path)
+            self._replay_pending = False
+
+db_breaker = CircuitBreaker()
+replica_breaker = CircuitBreaker("Реплика")
+write_spool = WriteSpool(DB_SPOOL_PATH)
+atexit.register(write_spool.close)
 
 # --- ФУНКЦИИ РАБОТЫ С БАЗОЙ ДАННЫХ POSTGRESQL ---
 
+def on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
 def get_db_connection():
-    return psycopg2.connect(DATABASE_URL)
+    # Из event loop не пробуем разомкнутый предохранитель: БД проверяет db_spool_job в своём потоке
+    on_loop = on_event_loop()
+    if not db_breaker.allow_request(probe=not on_loop):
+        raise DatabaseUnavailable("БД недоступна (предохранитель разомкнут)")
+    try:
+        conn = psycopg2.connect(DATABASE_URL, connect_timeout=DB_LOOP_CONNECT_TIMEOUT if on_loop else DB_CONNECT_TIMEOUT)
+    except psycopg2.OperationalError as e:
+        db_breaker.record_failure(trip=on_loop)
+        raise DatabaseUnavailable(str(e)) from e
+    db_breaker.record_success()
+    return conn
+
+replica_lag = {'checked_at': -math.inf, 'seconds': 0.0}
+
+def measure_replica_lag(conn) -> float:
+    # Не реплика (например, второй локальный экземпляр) и реплика, догнавшая полученный WAL, не отстают
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0) END
+        """)
+        return float(cur.fetchone()[0])
+
+def get_replica_connection():
+    # Тяжёлые чтения админки и аналитики. Запись и чтения горячего пути всегда идут через get_db_connection.
+    # Без реплики, при её недоступности или отставании больше REPLICA_MAX_LAG читаем с первичной БД.
+    if not DATABASE_REPLICA_URL: return get_db_connection()
+    lag_fresh = time.monotonic() - replica_lag['checked_at'] < REPLICA_LAG_CHECK_INTERVAL
+    on_loop = on_event_loop()
+    if (lag_fresh and replica_lag['seconds'] > REPLICA_MAX_LAG) or not replica_breaker.allow_request(probe=not on_loop):
+        return get_db_connection()
+    try:
+        conn = psycopg2.connect(DATABASE_REPLICA_URL, connect_timeout=DB_LOOP_CONNECT_TIMEOUT if on_loop else DB_CONNECT_TIMEOUT)
+        conn.set_session(readonly=True)
+        if not lag_fresh:
+            replica_lag.update(checked_at=time.monotonic(), seconds=measure_replica_lag(conn))
+    except psycopg2.Error as e:
+        replica_breaker.record_failure(trip=on_loop)
+        logger.warning("Реплика недоступна, чтение с первичной БД: %s", e)
+        return get_db_connection()
+    replica_breaker.record_success()
+    if replica_lag['seconds'] > REPLICA_MAX_LAG:
+        logger.warning("Реплика отстаёт на %.0f с, чтение с первичной БД.", replica_lag['seconds'])
+        conn.close()
+        return get_db_connection()
+    return conn
+
+def check_replica():
+    # Проба реплики и замер отставания в потоке задачи: хендлеры в event loop разомкнутый
+    # предохранитель реплики не пробуют, а без этой проверки чтения остались бы на первичной БД.
+    if not replica_breaker.allow_request(): return
+    try:
+        conn = psycopg2.connect(DATABASE_REPLICA_URL, connect_timeout=DB_CONNECT_TIMEOUT)
+        try:
+            replica_lag.update(checked_at=time.monotonic(), seconds=measure_replica_lag(conn))
+        finally:
+            conn.close()
+    except psycopg2.Error as e:
+        replica_breaker.record_failure()
+        logger.warning("Реплика недоступна: %s", e)
+        return
+    replica_breaker.record_success()
+
+async def replica_check_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await asyncio.to_thread(check_replica)
+
+# Миграции применяются по порядку, каждая ровно один раз; номер последней хранится в schema_migrations.
+# Новые изменения схемы добавляются только в конец списка.
+MIGRATIONS = [
+    (1, "базовая схема", [
+        """CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY, first_name TEXT, username TEXT,
+            start_time TIMESTAMPTZ DEFAULT NOW(), last_active_time TIMESTAMPTZ DEFAULT NOW(),
+            chat_status TEXT DEFAULT 'idle', current_chat_partner BIGINT, current_chat_session TEXT,
+            is_banned BOOLEAN DEFAULT FALSE, warnings INTEGER DEFAULT 0, has_blocked_bot BOOLEAN DEFAULT FALSE
+        )""",
+        """CREATE TABLE IF NOT EXISTS chat_logs (
+            log_id SERIAL PRIMARY KEY, session_id TEXT NOT NULL, timestamp TIMESTAMPTZ DEFAULT NOW(),
+            sender_id BIGINT NOT NULL, partner_id BIGINT NOT NULL, message_id BIGINT NOT NULL,
+            message_type TEXT NOT NULL, message_text TEXT, file_id TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS message_links (
+            source_chat_id BIGINT NOT NULL, source_message_id BIGINT NOT NULL, dest_chat_id BIGINT NOT NULL,
+            dest_message_id BIGINT NOT NULL, timestamp TIMESTAMPTZ DEFAULT NOW(),
+            PRIMARY KEY (source_chat_id, source_message_id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_dest_message_psql ON message_links (dest_chat_id, dest_message_id)",
+        "CREATE INDEX IF NOT EXISTS idx_session_id_psql ON chat_logs (session_id)",
+    ]),
+    (2, "персистентность user_data и разговоров", [
+        """CREATE TABLE IF NOT EXISTS persistence_user_data (
+            user_id BIGINT PRIMARY KEY, data JSONB NOT NULL, updated_at TIMESTAMPTZ DEFAULT NOW()
+        )""",
+        """CREATE TABLE IF NOT EXISTS persistence_conversations (
+            handler_name TEXT NOT NULL, conversation_key TEXT NOT NULL, state JSONB NOT NULL,
+            PRIMARY KEY (handler_name, conversation_key)
+        )""",
+    ]),
+    (3, "частичный индекс по активным статусам", [
+        "CREATE INDEX IF NOT EXISTS idx_users_active_status ON users (chat_status) WHERE chat_status <> 'idle'",
+    ]),
+    (4, "полнотекстовый поиск по chat_logs", [
+        # Конфигурация 'simple': словаря для белорусского в PostgreSQL нет, стемминг не нужен
+        "ALTER TABLE chat_logs ADD COLUMN IF NOT EXISTS message_tsv tsvector GENERATED ALWAYS AS (to_tsvector('simple', COALESCE(message_text, ''))) STORED",
+        "CREATE INDEX IF NOT EXISTS idx_chat_logs_tsv ON chat_logs USING GIN (message_tsv)",
+    ]),
+    (5, "компактное хранение истории чатов", [
+        # Новые сообщения пишутся в chat_messages: числовой ключ сессии, smallint-тип, BIGINT-идентификатор
+        # и ссылка на словарь media_files вместо повторяющегося file_id. Старая таблица становится
+        # chat_logs_legacy и переносится утилитой backfill_chat_logs.py; представление chat_logs
+        # объединяет обе, поэтому чтение не зависит от хода переноса.
+        "CREATE TABLE IF NOT EXISTS message_types (type_id SMALLINT PRIMARY KEY, name TEXT UNIQUE NOT NULL)",
+        "INSERT INTO message_types (type_id, name) VALUES (0, 'unknown'), (1, 'text'), (2, 'sticker'), (3, 'photo'), (4, 'video'), "
+        "(5, 'voice'), (6, 'audio'), (7, 'document'), (8, 'video_note') ON CONFLICT DO NOTHING",
+        """CREATE TABLE IF NOT EXISTS chat_sessions (
+            session_key BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY, session_id TEXT UNIQUE NOT NULL,
+            started_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )""",
+        "CREATE TABLE IF NOT EXISTS media_files (media_id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY, file_id TEXT UNIQUE NOT NULL)",
+        """CREATE TABLE IF NOT EXISTS chat_messages (
+            log_id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY, session_key BIGINT NOT NULL,
+            timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW(), sender_id BIGINT NOT NULL, partner_id BIGINT NOT NULL,
+            message_id BIGINT NOT NULL, media_id BIGINT, message_type SMALLINT NOT NULL, message_text TEXT,
+            message_tsv tsvector GENERATED ALWAYS AS (to_tsvector('simple', COALESCE(message_text, ''))) STORED
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_chat_messages_session ON chat_messages (session_key)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_messages_tsv ON chat_messages USING GIN (message_tsv)",
+        "ALTER TABLE chat_logs RENAME TO chat_logs_legacy",
+        "SELECT setval(pg_get_serial_sequence('chat_messages', 'log_id'), COALESCE((SELECT MAX(log_id) FROM chat_logs_legacy), 0) + 1, false)",
+        "INSERT INTO chat_sessions (session_id) SELECT DISTINCT current_chat_session FROM users WHERE current_chat_session IS NOT NULL ON CONFLICT DO NOTHING",
+        """CREATE VIEW chat_logs AS
+            SELECT m.log_id, s.session_id, m.timestamp, m.sender_id, m.partner_id, m.message_id, t.name AS message_type,
+                   m.message_text, f.file_id, m.message_tsv
+            FROM chat_messages m
+            JOIN chat_sessions s ON s.session_key = m.session_key
+            JOIN message_types t ON t.type_id = m.message_type
+            LEFT JOIN media_files f ON f.media_id = m.media_id
+            UNION ALL
+            SELECT log_id, session_id, timestamp, sender_id, partner_id, message_id, message_type, message_text, file_id, message_tsv
+            FROM chat_logs_legacy""",
+        # Поиск идёт только по первичному ключу source, индекс по dest лишь удорожал каждую вставку
+        "DROP INDEX IF EXISTS idx_dest_message_psql",
+    ]),
+    (6, "индекс правок chat_messages", [
+        # Правки находят строку по (sender_id, message_id), без индекса каждая пачка — полный проход
+        "CREATE INDEX IF NOT EXISTS idx_chat_messages_sender_message ON chat_messages (sender_id, message_id)",
+    ]),
+    (7, "аналитические сводки", [
+        # Сводки строятся rollup_job по водяным знакам в rollup_state, каждая исходная строка учитывается один раз
+        "ALTER TABLE chat_sessions ADD COLUMN IF NOT EXISTS wait_seconds REAL",
+        """CREATE TABLE IF NOT EXISTS user_events (
+            event_id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY, timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            user_id BIGINT NOT NULL, event TEXT NOT NULL
+        )""",
+        "CREATE TABLE IF NOT EXISTS rollup_state (source TEXT PRIMARY KEY, watermark BIGINT NOT NULL DEFAULT 0, pending_upper BIGINT NOT NULL DEFAULT 0)",
+        "CREATE TABLE IF NOT EXISTS rollup_hourly (hour TIMESTAMPTZ PRIMARY KEY, messages INTEGER NOT NULL DEFAULT 0, media_messages INTEGER NOT NULL DEFAULT 0)",
+        """CREATE TABLE IF NOT EXISTS rollup_daily (
+            day DATE PRIMARY KEY, sessions INTEGER NOT NULL DEFAULT 0, session_messages BIGINT NOT NULL DEFAULT 0,
+            session_seconds DOUBLE PRECISION NOT NULL DEFAULT 0, matches INTEGER NOT NULL DEFAULT 0,
+            wait_seconds DOUBLE PRECISION NOT NULL DEFAULT 0, warnings INTEGER NOT NULL DEFAULT 0, bans INTEGER NOT NULL DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS rollup_histograms (
+            day DATE NOT NULL, metric TEXT NOT NULL, bucket SMALLINT NOT NULL, count INTEGER NOT NULL,
+            PRIMARY KEY (day, metric, bucket)
+        )""",
+        "CREATE TABLE IF NOT EXISTS rollup_active_users (day DATE NOT NULL, user_id BIGINT NOT NULL, PRIMARY KEY (day, user_id))",
+        """CREATE TABLE IF NOT EXISTS rollup_open_sessions (
+            session_id TEXT PRIMARY KEY, first_message_at TIMESTAMPTZ NOT NULL, last_message_at TIMESTAMPTZ NOT NULL, messages INTEGER NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_rollup_open_sessions_last ON rollup_open_sessions (last_message_at)",
+    ]),
+    (8, "время завершения чатов", [
+        # Сводки закрывают сессию по явному завершению, а не по тишине в чате
+        "ALTER TABLE chat_sessions ADD COLUMN IF NOT EXISTS ended_at TIMESTAMPTZ",
+    ]),
+]
+MESSAGE_TYPE_IDS = {'unknown': 0, 'text': 1, 'sticker': 2, 'photo': 3, 'video': 4, 'voice': 5, 'audio': 6, 'document': 7, 'video_note': 8}
+MIGRATIONS_LOCK_ID = 7_340_001
 
 def initialize_databases():
     with get_db_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY, first_name TEXT, username TEXT,
-                    start_time TIMESTAMPTZ DEFAULT NOW(), last_active_time TIMESTAMPTZ DEFAULT NOW(),
-                    chat_status TEXT DEFAULT 'idle', current_chat_partner BIGINT, current_chat_session TEXT,
-                    is_banned BOOLEAN DEFAULT FALSE, warnings INTEGER DEFAULT 0, has_blocked_bot BOOLEAN DEFAULT FALSE
-                )""")
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS chat_logs (
-                    log_id SERIAL PRIMARY KEY, session_id TEXT NOT NULL, timestamp TIMESTAMPTZ DEFAULT NOW(),
-                    sender_id BIGINT NOT NULL, partner_id BIGINT NOT NULL, message_id BIGINT NOT NULL,
-                    message_type TEXT NOT NULL, message_text TEXT, file_id TEXT
-                )""")
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS message_links (
-                    source_chat_id BIGINT NOT NULL, source_message_id BIGINT NOT NULL, dest_chat_id BIGINT NOT NULL,
-                    dest_message_id BIGINT NOT NULL, timestamp TIMESTAMPTZ DEFAULT NOW(),
-                    PRIMARY KEY (source_chat_id, source_message_id)
-                )""")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_dest_message_psql ON message_links (dest_chat_id, dest_message_id)")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_session_id_psql ON chat_logs (session_id)")
-    logger.info("Проверка/инициализация таблиц в базе данных завершена.")
+            cur.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at TIMESTAMPTZ DEFAULT NOW())")
+            cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+            if cur.fetchone()[0] >= MIGRATIONS[-1][0]:
+                logger.info("Схема базы данных актуальна, миграции не требуются.")
+                return
+            # Несколько инстансов могут стартовать одновременно: миграции применяет только один
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATIONS_LOCK_ID,))
+            cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+            current_version = cur.fetchone()[0]
+            for version, name, statements in MIGRATIONS:
+                if version <= current_version: continue
+                for statement in statements:
+                    cur.execute(statement)
+                cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+                logger.info("Применена миграция %s: %s", version, name)
+
+# Последние известные строки users. По ним работают check_if_banned и пересылка, пока БД недоступна;
+# пока журнал не перенесён, они новее, чем БД.
+user_cache: dict[int, dict] = {}
 
 def get_user(user_id):
-    with get_db_connection() as conn:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
-            user = cur.fetchone()
-            return dict(user) if user else None
+    if write_spool.active and user_id in user_cache:
+        return dict(user_cache[user_id])
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor(cursor_factory=DictCursor) as cur:
+                cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
+                user = cur.fetchone()
+    except DB_CONNECTION_ERRORS as e:
+        if is_connection_lost(e) and user_id in user_cache: return dict(user_cache[user_id])
+        raise
+    if not user: return None
+    user_cache[user_id] = dict(user)
+    return dict(user)
+
+def evict_user_cache(idle_seconds: float) -> int:
+    if write_spool.active: return 0
+    deadline = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=idle_seconds)
+    idle_ids = [uid for uid, row in user_cache.items() if not row.get('last_active_time') or row['last_active_time'] < deadline]
+    for uid in idle_ids: del user_cache[uid]
+    return len(idle_ids)
 
 def get_all_users():
-    with get_db_connection() as conn:
+    with get_replica_connection() as conn:
         with conn.cursor(cursor_factory=DictCursor) as cur:
             cur.execute("SELECT user_id, first_name, username, is_banned, has_blocked_bot, warnings FROM users")
             return {str(row['user_id']): dict(row) for row in cur.fetchall()}
 
 def update_user(user_data):
+    user_cache[user_data['user_id']] = dict(user_data)
+    write_or_spool('users', [user_data])
+
+def load_user_states_to_recover() -> tuple[list[int], list[str], list[tuple[str, str, str]]]:
+    # Чаты переживают перезапуск (состояние в БД), сбрасываются только "сломанные" пары,
+    # где собеседник уже не ссылается на пользователя. Ожидающие возвращаются в очередь.
     with get_db_connection() as conn:
         with conn.cursor() as cur:
             cur.execute("""
-                INSERT INTO users (user_id, first_name, username, start_time, last_active_time, chat_status, current_chat_partner, current_chat_session, is_banned, warnings, has_blocked_bot)
-                VALUES (%(user_id)s, %(first_name)s, %(username)s, %(start_time)s, %(last_active_time)s, %(chat_status)s, %(current_chat_partner)s, %(current_chat_session)s, %(is_banned)s, %(warnings)s, %(has_blocked_bot)s)
-                ON CONFLICT (user_id) DO UPDATE SET
-                    first_name = EXCLUDED.first_name, username = EXCLUDED.username, last_active_time = EXCLUDED.last_active_time,
-                    chat_status = EXCLUDED.chat_status, current_chat_partner = EXCLUDED.current_chat_partner,
-                    current_chat_session = EXCLUDED.current_chat_session, is_banned = EXCLUDED.is_banned,
-                    warnings = EXCLUDED.warnings, has_blocked_bot = EXCLUDED.has_blocked_bot;
-            """, user_data)
-
-def reset_all_user_statuses_on_startup():
-    try:
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("UPDATE users SET chat_status = %s, current_chat_partner = NULL, current_chat_session = NULL WHERE chat_status IN (%s, %s)",
-                            (CHAT_STATUS_IDLE, CHAT_STATUS_CHATTING, CHAT_STATUS_WAITING))
-        logger.info("Статусы пользователей в БД были сброшены после перезапуска.")
-    except Exception as e:
-        logger.error(f"Не удалось сбросить статусы пользователей в БД при запуске: {e}")
-
-def log_chat_message(sender_id: str, partner_id: str, message: Update.message, session_id: str):
+                UPDATE users u SET chat_status = %s, current_chat_partner = NULL, current_chat_session = NULL
+                WHERE u.chat_status = %s AND NOT EXISTS (
+                    SELECT 1 FROM users p
+                    WHERE p.user_id = u.current_chat_partner AND p.current_chat_partner = u.user_id AND p.chat_status = %s
+                ) RETURNING u.user_id
+            """, (CHAT_STATUS_IDLE, CHAT_STATUS_CHATTING, CHAT_STATUS_CHATTING))
+            broken_ids = [row[0] for row in cur.fetchall()]
+            cur.execute("SELECT user_id FROM users WHERE chat_status = %s ORDER BY last_active_time", (CHAT_STATUS_WAITING,))
+            waiting_ids = [str(row[0]) for row in cur.fetchall()]
+            cur.execute("SELECT current_chat_session, user_id, current_chat_partner FROM users WHERE chat_status = %s AND user_id < current_chat_partner",
+                        (CHAT_STATUS_CHATTING,))
+            active_chats = [(session_id, str(uid1), str(uid2)) for session_id, uid1, uid2 in cur.fetchall()]
+    return broken_ids, waiting_ids, active_chats
+
+def get_message_log_data(message: Update.message) -> dict:
     data = {'type': 'unknown', 'text': None, 'file_id': None}
     if message.text: data.update({'type': 'text', 'text': message.text})
     elif message.sticker: data.update({'type': 'sticker', 'file_id': message.sticker.file_id})
@@ -124,12 +645,810 @@ def log_chat_message(sender_id: str, partner_id: str, message: Update.message, s
     elif message.audio: data.update({'type': 'audio', 'file_id': message.audio.file_id, 'text': message.caption})
     elif message.document: data.update({'type': 'document', 'file_id': message.document.file_id, 'text': message.caption})
     elif message.video_note: data.update({'type': 'video_note', 'file_id': message.video_note.file_id})
-    message_id = message.message_id if hasattr(message, 'message_id') else 0
+    return data
+
+def log_chat_message(sender_id: str, partner_id: str, message: Update.message, session_id: str):
+    log_chat_messages(sender_id, partner_id, [message], session_id)
+
+def log_chat_messages(sender_id: str, partner_id: str, messages: list, session_id: str):
+    # Время фиксируется здесь, а не DEFAULT NOW(): строка может попасть в БД позже, из журнала
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+    rows = []
+    for message in messages:
+        data = get_message_log_data(message)
+        message_id = message.message_id if hasattr(message, 'message_id') else 0
+        rows.append((session_id, timestamp, int(sender_id), int(partner_id), message_id, MESSAGE_TYPE_IDS[data['type']], data['file_id'], data['text']))
+    write_or_spool('messages', rows)
+
+def create_chat_session(session_id: str, wait_seconds: float | None = None):
+    write_or_spool('sessions', [(session_id, datetime.datetime.now(datetime.timezone.utc), wait_seconds)])
+
+def close_chat_session(session_id: str):
+    write_or_spool('session_ends', [(session_id, datetime.datetime.now(datetime.timezone.utc))])
+
+def record_user_event(user_id: int, event: str):
+    write_or_spool('events', [(datetime.datetime.now(datetime.timezone.utc), user_id, event)])
+
+def search_chat_logs(query_text: str, user_id: int | None = None, session_id: str | None = None,
+                     date_from: datetime.date | None = None, date_to: datetime.date | None = None,
+                     before_log_id: int | None = None, limit: int = TEXT_SEARCH_PAGE_SIZE) -> list[dict]:
+    # Пагинация по ключу (log_id убывает): каждая страница — один проход по GIN-индексу без OFFSET
+    conditions, params = ["message_tsv @@ websearch_to_tsquery('simple', %s)"], [query_text]
+    if user_id:
+        conditions.append("(sender_id = %s OR partner_id = %s)")
+        params += [user_id, user_id]
+    if session_id:
+        conditions.append("session_id = %s")
+        params.append(session_id)
+    if date_from:
+        conditions.append("timestamp >= %s")
+        params.append(date_from)
+    if date_to:
+        conditions.append("timestamp < %s")
+        params.append(date_to + datetime.timedelta(days=1))
+    if before_log_id:
+        conditions.append("log_id < %s")
+        params.append(before_log_id)
+    with get_replica_connection() as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute(f"SELECT log_id, session_id, timestamp, sender_id, partner_id, message_type, message_text FROM chat_logs "
+                        f"WHERE {' AND '.join(conditions)} ORDER BY log_id DESC LIMIT %s", params + [limit])
+            return [dict(row) for row in cur.fetchall()]
+
+def save_message_links(from_id: int, to_id: int, message_id_pairs: list[tuple[int, int]]):
+    # Для каждой пары (исходное, пересланное) пишутся обе стороны, чтобы ответы работали в обе стороны
+    rows = []
+    for source_message_id, dest_message_id in message_id_pairs:
+        rows.append((from_id, source_message_id, to_id, dest_message_id))
+        rows.append((to_id, dest_message_id, from_id, source_message_id))
+    write_or_spool('links', rows)
+
+# Пакетные записи, общие для прямой записи и переноса журнала. Строки должны переживать JSON:
+# даты приходят из журнала строками, кортежи — списками.
+
+def write_chat_sessions(cur, rows: list):
+    execute_values(cur, "INSERT INTO chat_sessions (session_id, started_at, wait_seconds) VALUES %s ON CONFLICT DO NOTHING", rows)
+
+def write_users(cur, rows: list[dict]):
+    # ON CONFLICT DO UPDATE не может дважды затронуть одну строку, из нескольких версий остаётся последняя
+    latest = {row['user_id']: row for row in rows}
+    execute_values(cur, """
+        INSERT INTO users (user_id, first_name, username, start_time, last_active_time, chat_status, current_chat_partner, current_chat_session, is_banned, warnings, has_blocked_bot)
+        VALUES %s
+        ON CONFLICT (user_id) DO UPDATE SET
+            first_name = EXCLUDED.first_name, username = EXCLUDED.username, last_active_time = EXCLUDED.last_active_time,
+            chat_status = EXCLUDED.chat_status, current_chat_partner = EXCLUDED.current_chat_partner,
+            current_chat_session = EXCLUDED.current_chat_session, is_banned = EXCLUDED.is_banned,
+            warnings = EXCLUDED.warnings, has_blocked_bot = EXCLUDED.has_blocked_bot
+    """, list(latest.values()), template="(%(user_id)s, %(first_name)s, %(username)s, %(start_time)s, %(last_active_time)s, %(chat_status)s, "
+                                          "%(current_chat_partner)s, %(current_chat_session)s, %(is_banned)s, %(warnings)s, %(has_blocked_bot)s)")
+
+def write_chat_messages(cur, rows: list):
+    # Сессия могла не дойти до БД (например, её строка отвергнута при переносе журнала):
+    # она заводится здесь, как и media_files, чтобы сообщения чата продолжали сохраняться
+    session_ids = [(session_id,) for session_id in {row[0] for row in rows}]
+    execute_values(cur, "INSERT INTO chat_sessions (session_id) VALUES %s ON CONFLICT DO NOTHING", session_ids)
+    file_ids = [(row[6],) for row in rows if row[6]]
+    if file_ids:
+        execute_values(cur, "INSERT INTO media_files (file_id) VALUES %s ON CONFLICT (file_id) DO NOTHING", file_ids)
+    execute_values(cur, """
+        INSERT INTO chat_messages (session_key, timestamp, sender_id, partner_id, message_id, message_type, media_id, message_text)
+        SELECT s.session_key, v.timestamp, v.sender_id, v.partner_id, v.message_id, v.message_type, f.media_id, v.message_text
+        FROM (VALUES %s) AS v (session_id, timestamp, sender_id, partner_id, message_id, message_type, file_id, message_text)
+        LEFT JOIN chat_sessions s ON s.session_id = v.session_id
+        LEFT JOIN media_files f ON f.file_id = v.file_id
+    """, rows, template="(%s, %s::timestamptz, %s::bigint, %s::bigint, %s::bigint, %s::smallint, %s, %s)")
+
+def write_chat_session_ends(cur, rows: list):
+    # Сессия могла не дойти до БД и заводится здесь же; ON CONFLICT DO UPDATE не может дважды затронуть одну строку
+    first = {}
+    for session_id, ended_at in rows: first.setdefault(session_id, ended_at)
+    execute_values(cur, """
+        INSERT INTO chat_sessions (session_id, ended_at) VALUES %s
+        ON CONFLICT (session_id) DO UPDATE SET ended_at = COALESCE(chat_sessions.ended_at, EXCLUDED.ended_at)
+    """, list(first.items()), template="(%s, %s::timestamptz)")
+
+def write_message_links(cur, rows: list):
+    execute_values(cur, "INSERT INTO message_links (source_chat_id, source_message_id, dest_chat_id, dest_message_id) VALUES %s ON CONFLICT DO NOTHING", rows)
+
+def write_message_edits(cur, rows: list):
+    latest = {(row[0], row[1]): row for row in rows}
+    execute_values(cur, """
+        UPDATE chat_messages m SET message_text = v.message_text
+        FROM (VALUES %s) AS v (sender_id, message_id, message_text)
+        WHERE m.sender_id = v.sender_id AND m.message_id = v.message_id
+    """, list(latest.values()), template="(%s::bigint, %s::bigint, %s)")
+
+def write_user_events(cur, rows: list):
+    execute_values(cur, "INSERT INTO user_events (timestamp, user_id, event) VALUES %s", rows)
+
+# Порядок важен при переносе журнала: сессии должны появиться раньше сообщений, сообщения — раньше правок
+SPOOL_WRITERS = {'sessions': write_chat_sessions, 'users': write_users, 'messages': write_chat_messages,
+                 'session_ends': write_chat_session_ends, 'links': write_message_links, 'edits': write_message_edits, 'events': write_user_events}
+
+def write_or_spool(kind: str, rows: list):
+    if not rows: return
+    if not write_spool.active:
+        try:
+            with get_db_connection() as conn:
+                with conn.cursor() as cur:
+                    SPOOL_WRITERS[kind](cur, rows)
+            return
+        except DB_CONNECTION_ERRORS as e:
+            if not is_connection_lost(e): raise
+            if not isinstance(e, DatabaseUnavailable): db_breaker.record_failure(trip=on_event_loop())
+            logger.warning("Запись %s отложена в журнал: %s", kind, e)
+    write_spool.append(kind, rows)
+
+def replay_spool_rows(cur, kind: str, rows: list) -> list:
+    # Пачка идёт под SAVEPOINT; если БД её отвергла, строки повторяются по одной,
+    # и возвращаются только те, что отвергнуты сами по себе
+    cur.execute("SAVEPOINT replay")
+    try:
+        SPOOL_WRITERS[kind](cur, rows)
+        cur.execute("RELEASE SAVEPOINT replay")
+        return []
+    except DB_CONNECTION_ERRORS:
+        raise
+    except psycopg2.Error as e:
+        cur.execute("ROLLBACK TO SAVEPOINT replay")
+        cur.execute("RELEASE SAVEPOINT replay")
+        if len(rows) == 1:
+            logger.error("БД отвергла строку журнала (%s): %s", kind, e)
+            return rows
+    return [row for single in rows for row in replay_spool_rows(cur, kind, [single])]
+
+def replay_write_spool() -> int:
+    # Заодно единственная проба разомкнутого предохранителя: хендлеры в event loop её не делают
+    if not write_spool.active and not db_breaker.is_open: return 0
+    try:
+        # Сначала подключение: пока БД лежит, журнал даже не читается
+        with get_db_connection() as conn:
+            if not write_spool.active: return 0
+            entries = write_spool.take_for_replay()
+            grouped = {kind: [] for kind in SPOOL_WRITERS}
+            for entry in entries:
+                grouped[entry['kind']].extend(entry['rows'])
+            with conn.cursor() as cur:
+                rejected = {kind: replay_spool_rows(cur, kind, rows) for kind, rows in grouped.items() if rows}
+            rejected = {kind: rows for kind, rows in rejected.items() if rows}
+    except DB_CONNECTION_ERRORS as e:
+        if is_connection_lost(e):
+            if not isinstance(e, DatabaseUnavailable): db_breaker.record_failure()
+        else:
+            # Deadlock, отмена запроса и т.п.: файл остаётся в .replay и переносится следующим прогоном
+            logger.warning("Перенос журнала %s прерван, будет повторён: %s", write_spool.replay_path, e)
+        return 0
+    except Exception as e:
+        logger.error("Журнал %s не удалось перенести, он отложен в сторону: %s", write_spool.replay_path, e)
+        write_spool.finish_replay(failed=True)
+        return 0
+    if rejected:
+        logger.error("Из журнала отложено в сторону строк, отвергнутых БД: %s", sum(map(len, rejected.values())))
+    write_spool.finish_replay(rejected=rejected)
+    return len(entries)
+
+async def db_spool_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    if write_spool.needs_sync:
+        await asyncio.to_thread(write_spool.sync)
+    if write_spool.active or db_breaker.is_open:
+        replayed = await asyncio.to_thread(replay_write_spool)
+        if replayed: logger.info("Из журнала перенесено в БД записей: %s", replayed)
+
+# --- ПЕРСИСТЕНТНОСТЬ В POSTGRESQL ---
+
+class PostgresPersistence(BasePersistence):
+    # user_data подгружается лениво при первом обращении пользователя (refresh_user_data),
+    # изменения копятся в памяти и пишутся одной пачкой за интервал update_interval.
+    # Состояния ConversationHandler малы и читаются целиком при старте.
+
+    def __init__(self, update_interval: float = PERSISTENCE_UPDATE_INTERVAL, idle_ttl: float = PERSISTENCE_IDLE_TTL):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+                         update_interval=update_interval)
+        self.idle_ttl = idle_ttl
+        self._last_access: dict[int, float] = {}
+        # uid -> номер прогона выгрузки; снимается только тем же прогоном, а не возвращением пользователя
+        self._evicted: dict[int, int] = {}
+        self._eviction_generation = 0
+        # user_data хранится сериализованным: по снимку последней записи отсеиваются неизменившиеся строки
+        self._dirty_users: dict[int, str] = {}
+        self._written_users: dict[int, str] = {}
+        self._dropped_users: set[int] = set()
+        self._dirty_conversations: dict[tuple[str, str], object] = {}
+        self._write_task: asyncio.Task | None = None
+        self._write_lock = asyncio.Lock()
+
+    @staticmethod
+    def _load_user_data(user_id: int) -> dict | None:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT data FROM persistence_user_data WHERE user_id = %s", (user_id,))
+                row = cur.fetchone()
+                return row[0] if row else None
+
+    @staticmethod
+    def _write_batch(users: dict[int, str], dropped: set[int], conversations: dict[tuple[str, str], object]):
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                if users:
+                    execute_values(cur, """
+                        INSERT INTO persistence_user_data (user_id, data) VALUES %s
+                        ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = NOW()
+                    """, list(users.items()), template="(%s, %s::jsonb)")
+                if dropped:
+                    cur.execute("DELETE FROM persistence_user_data WHERE user_id = ANY(%s)", (list(dropped),))
+                to_upsert = [(name, key, Json(state)) for (name, key), state in conversations.items() if state is not None]
+                to_delete = [(name, key) for (name, key), state in conversations.items() if state is None]
+                if to_upsert:
+                    execute_values(cur, """
+                        INSERT INTO persistence_conversations (handler_name, conversation_key, state) VALUES %s
+                        ON CONFLICT (handler_name, conversation_key) DO UPDATE SET state = EXCLUDED.state
+                    """, to_upsert)
+                if to_delete:
+                    execute_values(cur, "DELETE FROM persistence_conversations WHERE (handler_name, conversation_key) IN (VALUES %s)", to_delete)
+
+    def _schedule_write(self):
+        # Application.update_persistence вызывает update_* для всех ключей через asyncio.gather,
+        # поэтому запись, запланированная после них, забирает весь интервал одной транзакцией.
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self):
+        async with self._write_lock:
+            users, self._dirty_users = self._dirty_users, {}
+            dropped, self._dropped_users = self._dropped_users, set()
+            conversations, self._dirty_conversations = self._dirty_conversations, {}
+            if not (users or dropped or conversations): return
+            # Снимок считается записанным сразу, чтобы правка, пришедшая во время записи, сравнивалась с ним
+            previous = {uid: self._written_users.get(uid) for uid in users}
+            self._written_users.update(users)
+            try:
+                await asyncio.to_thread(self._write_batch, users, dropped, conversations)
+            except Exception as e:
+                logger.error("Не удалось записать персистентные данные (%s юзеров, %s разговоров): %s", len(users), len(conversations), e)
+                # Возвращаем несохранённое обратно, не затирая более свежие изменения
+                for uid, data in users.items():
+                    self._dirty_users.setdefault(uid, data)
+                    if self._written_users.get(uid) == data:
+                        if previous[uid] is None: del self._written_users[uid]
+                        else: self._written_users[uid] = previous[uid]
+                self._dropped_users |= dropped - self._dirty_users.keys()
+                for key, state in conversations.items(): self._dirty_conversations.setdefault(key, state)
+
+    async def get_user_data(self) -> dict[int, dict]:
+        return {}
+
+    async def get_chat_data(self) -> dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        def load():
+            with get_db_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT conversation_key, state FROM persistence_conversations WHERE handler_name = %s", (name,))
+                    return {tuple(json.loads(key)): state for key, state in cur.fetchall()}
+        return await asyncio.to_thread(load)
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None) -> None:
+        self._dirty_conversations[(name, json.dumps(list(key)))] = new_state
+        self._schedule_write()
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        # PTB вызывает это для каждого, кто прислал апдейт, даже если user_data не менялся
+        snapshot = json.dumps(data, sort_keys=True)
+        self._dropped_users.discard(user_id)
+        if self._written_users.get(user_id) == snapshot:
+            self._dirty_users.pop(user_id, None)
+            return
+        self._dirty_users[user_id] = snapshot
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        # Выгрузка из памяти (evict_idle_users) тоже идёт через Application.drop_user_data,
+        # но запись в БД при этом удалять нельзя.
+        if user_id in self._evicted:
+            self._written_users.pop(user_id, None)
+            return
+        self._last_access.pop(user_id, None)
+        self._written_users.pop(user_id, None)
+        self._dirty_users.pop(user_id, None)
+        self._dropped_users.add(user_id)
+        self._schedule_write()
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        first_access = user_id not in self._last_access
+        self._last_access[user_id] = time.monotonic()
+        if not first_access: return
+        pending = self._dirty_users.get(user_id)
+        stored = json.loads(pending) if pending is not None else None
+        if pending is None:
+            try:
+                stored = await asyncio.to_thread(self._load_user_data, user_id)
+            except DB_CONNECTION_ERRORS as e:
+                if not is_connection_lost(e): raise
+                # Апдейт обрабатывается с пустым user_data, подгрузка повторится со следующим
+                del self._last_access[user_id]
+                logger.warning("Не удалось подгрузить user_data: %s", e)
+                return
+            if stored is not None: self._written_users.setdefault(user_id, json.dumps(stored, sort_keys=True))
+        for key, value in (stored or {}).items():
+            user_data.setdefault(key, value)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self._write_task: await asyncio.gather(self._write_task, return_exceptions=True)
+        await self._write_pending()
+
+    async def evict_idle_users(self, application: Application) -> int:
+        deadline = time.monotonic() - self.idle_ttl
+        idle_ids = [uid for uid, last in self._last_access.items() if last < deadline]
+        if not idle_ids: return 0
+        # Сначала сохраняем всё накопленное, чтобы при следующей подгрузке из БД не получить старые данные
+        await application.update_persistence()
+        await self.flush()
+        self._eviction_generation += 1
+        generation = self._eviction_generation
+        evicted_ids = []
+        for uid in idle_ids:
+            if self._last_access.get(uid, time.monotonic()) >= deadline: continue
+            del self._last_access[uid]
+            self._evicted[uid] = generation
+            evicted_ids.append(uid)
+            application.drop_user_data(uid)
+        try:
+            # Пользователь может вернуться до этого вызова: его данные уже снова в памяти,
+            # и drop_user_data всё равно не должен удалить строку из БД
+            await application.update_persistence()
+        finally:
+            for uid in evicted_ids:
+                if self._evicted.get(uid) == generation: del self._evicted[uid]
+        return len(evicted_ids)
+
+async def evict_idle_user_data_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    persistence = context.application.persistence
+    if isinstance(persistence, PostgresPersistence):
+        evicted = await persistence.evict_idle_users(context.application)
+        if evicted: logger.info("Выгружено из памяти user_data неактивных пользователей: %s", evicted)
+    evict_user_cache(PERSISTENCE_IDLE_TTL)
+
+# --- ТАЙМЕРЫ НЕАКТИВНОСТИ ---
+
+class TimerWheel:
+    # Хешированное колесо таймеров: постановка, перепланирование и отмена за O(1).
+    # Таймер срабатывает с точностью до одного тика; длинные задержки отсчитываются оборотами колеса.
+
+    def __init__(self, tick: float = TIMER_WHEEL_TICK, size: int = 512):
+        self.tick = tick
+        self.size = size
+        self._slots: list[dict] = [{} for _ in range(size)]
+        self._entries: dict = {}
+        self._cursor = 0
+        self._next_tick_at = time.monotonic() + tick
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def schedule(self, key, delay: float, payload=None):
+        self.cancel(key)
+        ticks = max(1, math.ceil(delay / self.tick))
+        slot = (self._cursor + ticks) % self.size
+        self._slots[slot][key] = [(ticks - 1) // self.size, payload, delay]
+        self._entries[key] = slot
+
+    def touch(self, key) -> bool:
+        slot = self._entries.get(key)
+        if slot is None: return False
+        _, payload, delay = self._slots[slot][key]
+        self.schedule(key, delay, payload)
+        return True
+
+    def cancel(self, key):
+        slot = self._entries.pop(key, None)
+        if slot is not None: self._slots[slot].pop(key, None)
+
+    def advance(self, now: float | None = None) -> list[tuple]:
+        now = time.monotonic() if now is None else now
+        expired = []
+        while self._next_tick_at <= now:
+            self._next_tick_at += self.tick
+            self._cursor = (self._cursor + 1) % self.size
+            slot = self._slots[self._cursor]
+            for key in list(slot):
+                entry = slot[key]
+                if entry[0] > 0:
+                    entry[0] -= 1
+                    continue
+                del slot[key]
+                del self._entries[key]
+                expired.append((key, entry[1]))
+        return expired
+
+def track_chat_activity(context: ContextTypes.DEFAULT_TYPE, session_id: str, user1_id_str: str, user2_id_str: str):
+    timer_wheel = context.bot_data.get('timer_wheel')
+    if not (timer_wheel and CHAT_IDLE_TIMEOUT and session_id): return
+    if not timer_wheel.touch(('chat', session_id)):
+        timer_wheel.schedule(('chat', session_id), CHAT_IDLE_TIMEOUT, (user1_id_str, user2_id_str))
+
+def track_search(context: ContextTypes.DEFAULT_TYPE, user_id_str: str):
+    timer_wheel = context.bot_data.get('timer_wheel')
+    if timer_wheel and SEARCH_TIMEOUT:
+        timer_wheel.schedule(('search', user_id_str), SEARCH_TIMEOUT)
+
+def cancel_timer(context: ContextTypes.DEFAULT_TYPE, kind: str, key: str | None):
+    timer_wheel = context.bot_data.get('timer_wheel')
+    if timer_wheel and key: timer_wheel.cancel((kind, key))
+
+async def expire_idle_chat(context: ContextTypes.DEFAULT_TYPE, session_id: str, user1_id_str: str, user2_id_str: str):
+    user_data = get_user(int(user1_id_str))
+    if not user_data or user_data.get('chat_status') != CHAT_STATUS_CHATTING or user_data.get('current_chat_session') != session_id: return
+    logger.info("Сессия %s завершена по неактивности.", session_id)
+    await end_chat_session(user1_id_str, user2_id_str, context, initiator_id_str=None,
+                           end_text="⏱ Чат завершаны праз адсутнасьць актыўнасьці.")
+
+async def expire_search(context: ContextTypes.DEFAULT_TYPE, user_id_str: str):
+    async with context.bot_data['chat_search_lock']:
+        waiting_queue = context.bot_data.setdefault('waiting_queue', [])
+        if user_id_str not in waiting_queue: return
+        waiting_queue.remove(user_id_str)
+        context.bot_data['search_started'].pop(user_id_str, None)
+        user_data = get_user(int(user_id_str))
+        if user_data and user_data.get('chat_status') == CHAT_STATUS_WAITING:
+            user_data['chat_status'] = CHAT_STATUS_IDLE
+            update_user(user_data)
+    try:
+        await context.bot.send_message(user_id_str, "⏱ Суразмоўцу пакуль ня знойдзена, пошук спынены.\n\nКаб паспрабаваць зноў, выкарыстоўвайце /search.",
+                                       reply_markup=ADMIN_MAIN_MENU_KEYBOARD if is_admin(user_id_str) else ReplyKeyboardRemove())
+    except Forbidden: mark_user_as_bot_blocker(user_id_str)
+    except Exception as e: logger.error("Не атрымалася апавясьціць %s пра спыненьне пошуку: %s", user_id_str, e)
+
+async def timer_wheel_tick_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    for (kind, key), payload in context.bot_data['timer_wheel'].advance():
+        try:
+            if kind == 'chat': await expire_idle_chat(context, key, *payload)
+            elif kind == 'search': await expire_search(context, key)
+        except Exception as e: logger.error("Памылка апрацоўкі таймера %s %s: %s", kind, key, e)
+
+# --- ПРОФИЛИРОВАНИЕ И СТОРОЖ EVENT LOOP ---
+
+def collapse_stack(frame) -> str:
+    parts = []
+    while frame is not None:
+        parts.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+def innermost_bot_function(frame) -> str | None:
+    while frame is not None:
+        if frame.f_code.co_filename == __file__: return frame.f_code.co_name
+        frame = frame.f_back
+    return None
+
+def percentile(values: list[float], q: float) -> float:
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+class LoopMonitor:
+    # Фоновый поток раз в 100 мс проверяет пульс event loop и, если loop не отвечает дольше
+    # LOOP_BLOCK_THRESHOLD, запоминает стек блокирующего кода (например, синхронного psycopg2).
+    # По запросу тот же поток семплирует стек потока loop и считает время по обработчикам.
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, block_threshold: float = LOOP_BLOCK_THRESHOLD):
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        self.block_threshold = block_threshold
+        self.heartbeat = time.perf_counter()
+        self.blocks: deque = deque(maxlen=50)
+        self.profile: dict | None = None
+        try:
+            self._cpu_clock = time.pthread_getcpuclockid(self.loop_thread_id)
+        except (AttributeError, OSError):
+            self._cpu_clock = None
+        self._thread = threading.Thread(target=self._watch, name="loop-monitor", daemon=True)
+
+    def start(self, application: Application):
+        application.create_task(self._heartbeat_loop(), name="loop_monitor_heartbeat")
+        self._thread.start()
+
+    def _cpu_time(self) -> float:
+        return time.clock_gettime(self._cpu_clock) if self._cpu_clock is not None else 0.0
+
+    async def _heartbeat_loop(self, interval: float = 0.05):
+        while True:
+            expected = time.perf_counter() + interval
+            await asyncio.sleep(interval)
+            self.heartbeat = now = time.perf_counter()
+            if self.profile is not None: self.profile['lags'].append(now - expected)
+
+    def _watch(self):
+        stalled_heartbeat, stall_stack = None, None
+        while True:
+            profile = self.profile
+            time.sleep(profile['interval'] if profile else 0.1)
+            frame = sys._current_frames().get(self.loop_thread_id)
+            heartbeat = self.heartbeat
+            if stalled_heartbeat is not None and heartbeat != stalled_heartbeat:
+                block = {'duration': heartbeat - stalled_heartbeat, 'stack': stall_stack, 'at': datetime.datetime.now(datetime.timezone.utc)}
+                self.blocks.append(block)
+                if self.profile is not None: self.profile['blocks'].append(block)
+                logger.warning("Event loop быў заблякаваны %.0f мс: %s", block['duration'] * 1000, stall_stack)
+                stalled_heartbeat = None
+            if self.block_threshold and stalled_heartbeat is None and frame is not None and time.perf_counter() - heartbeat > self.block_threshold:
+                stalled_heartbeat, stall_stack = heartbeat, collapse_stack(frame)
+            if profile is not None and frame is not None:
+                self._sample(profile, frame)
+
+    def _sample(self, profile: dict, frame):
+        wall, cpu = time.perf_counter(), self._cpu_time()
+        label = innermost_bot_function(frame)
+        if label is None:
+            task = asyncio.current_task(self.loop)
+            label = task.get_coro().__qualname__ if task else "<па-за задачамі>"
+        profile['stacks'][f"{label};{collapse_stack(frame)}"] += 1
+        profile['wall'][label] += wall - profile['last_wall']
+        profile['cpu'][label] += cpu - profile['last_cpu']
+        profile['last_wall'], profile['last_cpu'] = wall, cpu
+
+    async def run_profile(self, seconds: float, interval: float = PROFILER_SAMPLE_INTERVAL) -> dict:
+        self.profile = {'interval': interval, 'block_threshold': self.block_threshold, 'stacks': Counter(), 'wall': Counter(), 'cpu': Counter(), 'lags': [], 'blocks': [],
+                        'last_wall': time.perf_counter(), 'last_cpu': self._cpu_time(), 'started': time.perf_counter()}
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profile, self.profile = self.profile, None
+        await asyncio.sleep(interval * 2)  # даём потоку завершить текущий семпл
+        profile['duration'] = time.perf_counter() - profile['started']
+        return profile
+
+def render_profile_summary(profile: dict) -> str:
+    lags = profile['lags']
+    lines = [f"🔬 Прафіль за {profile['duration']:.1f} с, сэмплаў: {sum(profile['stacks'].values())}",
+             f"Затрымка event loop: p50 {percentile(lags, 50) * 1000:.1f} мс, p99 {percentile(lags, 99) * 1000:.1f} мс, max {max(lags, default=0) * 1000:.1f} мс",
+             "", "Топ па сьценным часе / CPU:"]
+    for label, wall in profile['wall'].most_common(10):
+        lines.append(f"  {label}: {wall * 1000:.0f} мс / {profile['cpu'][label] * 1000:.0f} мс CPU")
+    if profile['blocks']:
+        lines += ["", f"Блякаваньні loop > {profile['block_threshold'] * 1000:.0f} мс:"]
+        for block in sorted(profile['blocks'], key=lambda b: -b['duration'])[:5]:
+            # Три самых глубоких кадра, начиная с того, где loop стоял
+            innermost_frames = block['stack'].rsplit(';', 3)[-3:]
+            lines.append(f"  {block['duration'] * 1000:.0f} мс: {' ← '.join(reversed(innermost_frames))}")
+    return "\n".join(lines)
+
+async def run_and_send_profile(context: ContextTypes.DEFAULT_TYPE, seconds: int):
+    monitor = context.bot_data['loop_monitor']
+    try:
+        profile = await monitor.run_profile(seconds)
+        collapsed = "\n".join(f"{stack} {count}" for stack, count in profile['stacks'].most_common())
+        filename = f"profile_{datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.collapsed"
+        await context.bot.send_message(ADMIN_CHAT_ID, f"<pre>{html.escape(render_profile_summary(profile))}</pre>", parse_mode=ParseMode.HTML)
+        if collapsed:
+            await context.bot.send_document(ADMIN_CHAT_ID, document=InputFile(collapsed.encode('utf-8'), filename=filename),
+                                            caption="Collapsed stacks для flamegraph.pl / speedscope.app")
+    except Exception as e:
+        logger.error("Памылка прафіляваньня: %s", e)
+        await context.bot.send_message(ADMIN_CHAT_ID, f"❌ Памылка прафіляваньня: {e}")
+
+# --- АНАЛИТИЧЕСКИЕ СВОДКИ ---
+# Каждый источник сворачивается в сводные таблицы пачками по диапазону ключа выше водяного знака.
+# Пачка и сдвиг знака коммитятся вместе, поэтому строка учитывается ровно один раз.
+# Отчёты (/trends) читают только сводки и не трогают chat_logs.
+
+def fold_chat_logs(cur, low: int, high: int):
+    # Сессии копятся в rollup_open_sessions, пока не завершатся (finalize_rollup_sessions)
+    cur.execute("""
+        WITH batch AS MATERIALIZED (
+            SELECT session_id, timestamp, sender_id, file_id FROM chat_logs WHERE log_id > %(low)s AND log_id <= %(high)s
+        ), hourly AS (
+            INSERT INTO rollup_hourly (hour, messages, media_messages)
+            SELECT date_trunc('hour', timestamp), COUNT(*), COUNT(file_id) FROM batch GROUP BY 1
+            ON CONFLICT (hour) DO UPDATE SET messages = rollup_hourly.messages + EXCLUDED.messages,
+                                             media_messages = rollup_hourly.media_messages + EXCLUDED.media_messages
+        ), active AS (
+            INSERT INTO rollup_active_users (day, user_id)
+            SELECT DISTINCT (timestamp AT TIME ZONE %(tz)s)::date, sender_id FROM batch
+            ON CONFLICT DO NOTHING
+        )
+        INSERT INTO rollup_open_sessions (session_id, first_message_at, last_message_at, messages)
+        SELECT session_id, MIN(timestamp), MAX(timestamp), COUNT(*) FROM batch GROUP BY session_id
+        ON CONFLICT (session_id) DO UPDATE SET
+            first_message_at = LEAST(rollup_open_sessions.first_message_at, EXCLUDED.first_message_at),
+            last_message_at = GREATEST(rollup_open_sessions.last_message_at, EXCLUDED.last_message_at),
+            messages = rollup_open_sessions.messages + EXCLUDED.messages
+    """, {'low': low, 'high': high, 'tz': ROLLUP_TIMEZONE})
+
+def fold_matches(cur, low: int, high: int):
+    # Сессии без wait_seconds созданы не поиском (перенос истории, восстановление после рестарта)
+    cur.execute("""
+        WITH batch AS MATERIALIZED (
+            SELECT (started_at AT TIME ZONE %(tz)s)::date AS day, wait_seconds::float8 AS wait_seconds FROM chat_sessions
+            WHERE session_key > %(low)s AND session_key <= %(high)s AND wait_seconds IS NOT NULL
+        ), daily AS (
+            INSERT INTO rollup_daily (day, matches, wait_seconds)
+            SELECT day, COUNT(*), SUM(wait_seconds) FROM batch GROUP BY day
+            ON CONFLICT (day) DO UPDATE SET matches = rollup_daily.matches + EXCLUDED.matches,
+                                            wait_seconds = rollup_daily.wait_seconds + EXCLUDED.wait_seconds
+        )
+        INSERT INTO rollup_histograms (day, metric, bucket, count)
+        SELECT day, 'wait_seconds', width_bucket(wait_seconds, %(buckets)s::float8[]), COUNT(*) FROM batch GROUP BY 1, 3
+        ON CONFLICT (day, metric, bucket) DO UPDATE SET count = rollup_histograms.count + EXCLUDED.count
+    """, {'low': low, 'high': high, 'tz': ROLLUP_TIMEZONE, 'buckets': ROLLUP_HISTOGRAMS['wait_seconds']})
+
+def fold_user_events(cur, low: int, high: int):
+    cur.execute("""
+        INSERT INTO rollup_daily (day, warnings, bans)
+        SELECT (timestamp AT TIME ZONE %(tz)s)::date, COUNT(*) FILTER (WHERE event = 'warning'), COUNT(*) FILTER (WHERE event = 'ban')
+        FROM user_events WHERE event_id > %(low)s AND event_id <= %(high)s GROUP BY 1
+        ON CONFLICT (day) DO UPDATE SET warnings = rollup_daily.warnings + EXCLUDED.warnings, bans = rollup_daily.bans + EXCLUDED.bans
+    """, {'low': low, 'high': high, 'tz': ROLLUP_TIMEZONE})
+
+def finalize_rollup_sessions(cur):
+    # Закрываются только сессии, все сообщения которых уже свёрнуты (log_id не выше водяного знака chat_logs):
+    # иначе строки, дошедшие позже (перенос журнала), открыли бы сессию заново и она посчиталась бы дважды
+    cur.execute("""
+        WITH closed AS (
+            DELETE FROM rollup_open_sessions o
+            WHERE (EXISTS (SELECT 1 FROM chat_sessions s WHERE s.session_id = o.session_id AND s.ended_at IS NOT NULL)
+                   OR (o.last_message_at < NOW() - make_interval(secs => %(settle)s)
+                       AND NOT EXISTS (SELECT 1 FROM users u WHERE u.chat_status <> %(idle)s AND u.current_chat_session = o.session_id)))
+              AND NOT EXISTS (SELECT 1 FROM chat_messages m JOIN chat_sessions s ON s.session_key = m.session_key
+                              WHERE s.session_id = o.session_id
+                                AND m.log_id > (SELECT watermark FROM rollup_state WHERE source = 'chat_logs'))
+            RETURNING (first_message_at AT TIME ZONE %(tz)s)::date AS day, messages,
+                      EXTRACT(EPOCH FROM last_message_at - first_message_at)::float8 AS seconds
+        ), daily AS (
+            INSERT INTO rollup_daily (day, sessions, session_messages, session_seconds)
+            SELECT day, COUNT(*), SUM(messages), SUM(seconds) FROM closed GROUP BY day
+            ON CONFLICT (day) DO UPDATE SET sessions = rollup_daily.sessions + EXCLUDED.sessions,
+                                            session_messages = rollup_daily.session_messages + EXCLUDED.session_messages,
+                                            session_seconds = rollup_daily.session_seconds + EXCLUDED.session_seconds
+        ), histograms AS (
+            INSERT INTO rollup_histograms (day, metric, bucket, count)
+            SELECT day, metric, bucket, COUNT(*) FROM (
+                SELECT day, 'session_seconds' AS metric, width_bucket(seconds, %(seconds_buckets)s::float8[]) AS bucket FROM closed
+                UNION ALL
+                SELECT day, 'session_messages', width_bucket(messages, %(messages_buckets)s::int[]) FROM closed
+            ) h GROUP BY day, metric, bucket
+            ON CONFLICT (day, metric, bucket) DO UPDATE SET count = rollup_histograms.count + EXCLUDED.count
+        )
+        SELECT COUNT(*) FROM closed
+    """, {'settle': ROLLUP_SESSION_SETTLE, 'idle': CHAT_STATUS_IDLE, 'tz': ROLLUP_TIMEZONE,
+          'seconds_buckets': ROLLUP_HISTOGRAMS['session_seconds'], 'messages_buckets': ROLLUP_HISTOGRAMS['session_messages']})
+    return cur.fetchone()[0]
+
+# Источник, запрос максимального ключа (по индексу, без прохода по представлению) и функция свёртки
+ROLLUP_SOURCES = [
+    ('chat_logs', "SELECT GREATEST((SELECT MAX(log_id) FROM chat_messages), (SELECT MAX(log_id) FROM chat_logs_legacy))", fold_chat_logs),
+    ('chat_sessions', "SELECT MAX(session_key) FROM chat_sessions", fold_matches),
+    ('user_events', "SELECT MAX(event_id) FROM user_events", fold_user_events),
+]
+
+def advance_rollup(conn, source: str, max_key_query: str, fold) -> int:
+    # Знак двухфазный: прогон обрабатывает ключи до максимума, замеченного прошлым прогоном.
+    # Транзакции, взявшие меньшие ключи, к этому времени уже закоммичены, и их строки не проскочат мимо знака.
+    with conn.cursor() as cur:
+        cur.execute("INSERT INTO rollup_state (source) VALUES (%s) ON CONFLICT DO NOTHING", (source,))
+        cur.execute("SELECT watermark, pending_upper FROM rollup_state WHERE source = %s", (source,))
+        start, upper = cur.fetchone()
+        cur.execute(max_key_query)
+        next_upper = cur.fetchone()[0] or 0
+        watermark = start
+        while watermark < upper:
+            high = min(watermark + ROLLUP_BATCH_SIZE, upper)
+            fold(cur, watermark, high)
+            cur.execute("UPDATE rollup_state SET watermark = %s WHERE source = %s", (high, source))
+            conn.commit()
+            watermark = high
+        cur.execute("UPDATE rollup_state SET pending_upper = GREATEST(pending_upper, %s) WHERE source = %s", (next_upper, source))
+    conn.commit()
+    return watermark - start
+
+def run_rollups() -> tuple[int, int]:
     with get_db_connection() as conn:
+        processed = sum(advance_rollup(conn, *source) for source in ROLLUP_SOURCES)
         with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO chat_logs (session_id, sender_id, partner_id, message_id, message_type, message_text, file_id) VALUES (%s, %s, %s, %s, %s, %s, %s)",
-                (session_id, int(sender_id), int(partner_id), message_id, data['type'], data['text'], data['file_id']))
+            closed_sessions = finalize_rollup_sessions(cur)
+    return processed, closed_sessions
+
+async def rollup_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        processed, closed_sessions = await asyncio.to_thread(run_rollups)
+    except Exception as e:
+        logger.error("Не удалось обновить аналитические сводки: %s", e)
+        return
+    if processed or closed_sessions:
+        logger.info("Сводки обновлены: диапазон ключей %s, завершённых чатов %s", processed, closed_sessions)
+
+def load_trends(weeks: int) -> dict:
+    today = datetime.datetime.now(ZoneInfo(ROLLUP_TIMEZONE)).date()
+    since = today - datetime.timedelta(days=today.weekday() + 7 * (weeks - 1))
+    params = {'since': since, 'since_ts': datetime.datetime.combine(since, datetime.time(), ZoneInfo(ROLLUP_TIMEZONE)), 'tz': ROLLUP_TIMEZONE}
+    with get_replica_connection() as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute("""
+                SELECT date_trunc('week', day)::date AS week, SUM(sessions) AS sessions, SUM(session_messages) AS session_messages,
+                       SUM(session_seconds) AS session_seconds, SUM(matches) AS matches, SUM(wait_seconds) AS wait_seconds,
+                       SUM(warnings) AS warnings, SUM(bans) AS bans
+                FROM rollup_daily WHERE day >= %(since)s GROUP BY 1
+            """, params)
+            weekly = {row['week']: dict(row) for row in cur.fetchall()}
+            cur.execute("""
+                SELECT date_trunc('week', day)::date AS week, COUNT(DISTINCT user_id) AS weekly_active, COUNT(*) AS daily_active
+                FROM rollup_active_users WHERE day >= %(since)s GROUP BY 1
+            """, params)
+            for row in cur.fetchall():
+                weekly.setdefault(row['week'], {'week': row['week']}).update(weekly_active=row['weekly_active'], daily_active=row['daily_active'])
+            cur.execute("SELECT metric, bucket, SUM(count) FROM rollup_histograms WHERE day >= %(since)s GROUP BY 1, 2", params)
+            histograms = {}
+            for metric, bucket, count in cur.fetchall():
+                histograms.setdefault(metric, {})[bucket] = count
+            cur.execute("""
+                SELECT EXTRACT(HOUR FROM hour AT TIME ZONE %(tz)s)::int, SUM(messages) FROM rollup_hourly
+                WHERE hour >= %(since_ts)s GROUP BY 1
+            """, params)
+            hourly = dict(cur.fetchall())
+    return {'today': today, 'since': since, 'weeks': [weekly[week] for week in sorted(weekly)], 'histograms': histograms, 'hourly': hourly}
+
+def format_duration(seconds: float) -> str:
+    if seconds >= 3600: return f"{seconds / 3600:g} г"
+    if seconds >= 60: return f"{seconds / 60:g} хв"
+    return f"{seconds:g} с"
+
+def render_histogram(title: str, thresholds: list, counts: dict, fmt=str) -> list[str]:
+    # Корзины как у width_bucket: 0 — меньше первого порога, i — [порог i-1, порог i), последняя — от последнего порога
+    labels = [f"< {fmt(thresholds[0])}"] + [f"{fmt(a)}–{fmt(b)}" for a, b in zip(thresholds, thresholds[1:])] + [f"≥ {fmt(thresholds[-1])}"]
+    total = sum(counts.values())
+    lines = ["", f"{title} (усяго {total}):"]
+    for bucket, label in enumerate(labels):
+        share = counts.get(bucket, 0) / total * 100 if total else 0
+        lines.append(f"  {label:>11} {counts.get(bucket, 0):>7} {share:5.1f}% {'█' * round(share / 5)}")
+    return lines
+
+def render_trends(trends: dict) -> str:
+    lines = [f"📈 Трэнды з {trends['since']} ({ROLLUP_TIMEZONE})", "",
+             "Тыдзень      DAU   WAU  Чатаў  Хв/чат Пав/чат  Пар  Чак,с  Банаў  ‰WAU"]
+    for week in trends['weeks']:
+        days = min(7, (trends['today'] - week['week']).days + 1)
+        sessions, matches, wau = week.get('sessions') or 0, week.get('matches') or 0, week.get('weekly_active') or 0
+        bans = week.get('bans') or 0
+        lines.append(f"{week['week']} {(week.get('daily_active') or 0) / days:5.0f} {wau:5} {sessions:6} "
+                     f"{(week.get('session_seconds') or 0) / 60 / sessions if sessions else 0:7.1f} "
+                     f"{(week.get('session_messages') or 0) / sessions if sessions else 0:7.1f} {matches:4} "
+                     f"{(week.get('wait_seconds') or 0) / matches if matches else 0:6.0f} {bans:6} {bans / wau * 1000 if wau else 0:5.1f}")
+    histograms = trends['histograms']
+    lines += render_histogram("Працягласьць чатаў", ROLLUP_HISTOGRAMS['session_seconds'], histograms.get('session_seconds', {}), format_duration)
+    lines += render_histogram("Паведамленьняў за чат", ROLLUP_HISTOGRAMS['session_messages'], histograms.get('session_messages', {}))
+    lines += render_histogram("Чаканьне суразмоўцы", ROLLUP_HISTOGRAMS['wait_seconds'], histograms.get('wait_seconds', {}), format_duration)
+    if trends['hourly']:
+        peak_hours = sorted(trends['hourly'].items(), key=lambda item: -item[1])[:3]
+        lines += ["", "Пікавыя гадзіны: " + ", ".join(f"{hour:02d}:00 ({messages})" for hour, messages in peak_hours)]
+    return "\n".join(lines)
 
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
 
@@ -142,7 +1461,21 @@ def check_if_banned(func):
         if not user_telegram: return
 
         user_id = user_telegram.id
-        user_data = get_user(user_id)
+        token = log_context.set({'user_id': user_id, 'handler': func.__name__})
+        try:
+            return await handle_checked_update(update, context, user_telegram, *args, **kwargs)
+        finally:
+            log_context.reset(token)
+
+    async def handle_checked_update(update: Update, context: ContextTypes.DEFAULT_TYPE, user_telegram, *args, **kwargs):
+        user_id = user_telegram.id
+        try:
+            user_data = get_user(user_id)
+        except DB_CONNECTION_ERRORS as e:
+            if not is_connection_lost(e): raise
+            # Без БД не узнать, не забанен ли пользователь, которого нет в кэше
+            logger.warning("БД недоступна, апдейт пользователя не из кэша пропущен: %s", e)
+            return
 
         is_new_user = not user_data
         if is_new_user:
@@ -152,9 +1485,11 @@ def check_if_banned(func):
                 "chat_status": CHAT_STATUS_IDLE, "current_chat_partner": None, "current_chat_session": None,
                 "is_banned": False, "warnings": 0, "has_blocked_bot": False
             }
-            logger.info(f"Зарегистрирован новый пользователь: {user_id} ({user_telegram.first_name})")
+            logger.info("Зарегистрирован новый пользователь: %s (%s)", user_id, user_telegram.first_name)
         
-        context.user_data['is_new_user'] = is_new_user
+        # Флаг нужен только этому апдейту, поэтому живёт в context, а не в сохраняемом user_data
+        context.is_new_user = is_new_user
+        context.user_data.pop('is_new_user', None)
         
         if user_data.get('is_banned', False):
             if update.message and update.message.text == AMNESTY_CODE:
@@ -198,14 +1533,14 @@ def mark_user_as_bot_blocker(user_id: str):
     if user_data and not user_data.get('has_blocked_bot'):
         user_data['has_blocked_bot'] = True
         update_user(user_data)
-        logger.info(f"User {user_id} has likely blocked the bot. Marked.")
+        logger.info("User %s has likely blocked the bot. Marked.", user_id)
 
 # --- ОСНОВНЫЕ ФУНКЦИИ БОТА ---
 
 @check_if_banned
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
-    is_new_user = context.user_data.get('is_new_user', False)
+    is_new_user = getattr(context, 'is_new_user', False)
     if is_admin(str(user.id)):
         welcome_text = "Вітаю, Адміністратар! Вашая адмысловая клявіятура актываваная."
         reply_markup = ADMIN_MAIN_MENU_KEYBOARD
@@ -240,15 +1575,20 @@ async def connect_users(user1_id_str: str, user2_id_str: str, context: ContextTy
     user1_data = get_user(int(user1_id_str))
     user2_data = get_user(int(user2_id_str))
     session_id = f"session_{uuid.uuid4().hex[:12]}"
+    # Ожидание пары — от начала поиска того, кто стоял в очереди (пары, восстановленные после рестарта, без него)
+    search_started = [context.bot_data['search_started'].pop(uid, None) for uid in (user1_id_str, user2_id_str)]
+    waited_since = min((started for started in search_started if started is not None), default=None)
+    create_chat_session(session_id, time.monotonic() - waited_since if waited_since is not None else None)
     user1_data.update({'chat_status': CHAT_STATUS_CHATTING, 'current_chat_partner': int(user2_id_str), 'current_chat_session': session_id})
     user2_data.update({'chat_status': CHAT_STATUS_CHATTING, 'current_chat_partner': int(user1_id_str), 'current_chat_session': session_id})
     update_user(user1_data)
     update_user(user2_data)
+    track_chat_activity(context, session_id, user1_id_str, user2_id_str)
     connect_message = "✅ Суразмоўца знойдзены! Можаце пачынаць зносіны."
     for uid in [user1_id_str, user2_id_str]:
         try:
             await context.bot.send_message(uid, connect_message)
-        except Exception as e: logger.error(f"Не атрымалася апавясьціць {uid}: {e}")
+        except Exception as e: logger.error("Не атрымалася апавясьціць %s: %s", uid, e)
 
 @check_if_banned
 async def start_chat_logic(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -267,10 +1607,13 @@ async def start_chat_logic(update: Update, context: ContextTypes.DEFAULT_TYPE):
             waiting_queue.remove(user_id_str)
         if len(waiting_queue) > 0:
             partner_id = waiting_queue.pop(0)
+            cancel_timer(context, 'search', partner_id)
             asyncio.create_task(connect_users(partner_id, user_id_str, context))
             return
         if user_id_str not in waiting_queue:
             waiting_queue.append(user_id_str)
+            context.bot_data['search_started'][user_id_str] = time.monotonic()
+            track_search(context, user_id_str)
     await update.message.reply_text("🔎 Шукаем суразмоўцу...")
 
 @check_if_banned
@@ -290,8 +1633,10 @@ async def process_post_chat_warnings(user_id_str: str, context: ContextTypes.DEF
         if user_data:
             current_warnings = user_data.get('warnings', 0) + 1
             user_data['warnings'] = current_warnings
+            record_user_event(user_data['user_id'], 'warning')
             if current_warnings >= WARNING_LIMIT:
                 user_data['is_banned'] = True
+                record_user_event(user_data['user_id'], 'ban')
                 ban_message = (f"❗️Вы атрымалі {current_warnings}/{WARNING_LIMIT} папярэджаньняў за выкарыстаньне літараў небеларускага альфабэту. Ваш доступ да чата заблякаваны.")
                 await context.bot.send_message(user_id_str, ban_message, parse_mode=ParseMode.MARKDOWN)
             else:
@@ -299,17 +1644,21 @@ async def process_post_chat_warnings(user_id_str: str, context: ContextTypes.DEF
             update_user(user_data)
         if user_id_str in chat_flags: del chat_flags[user_id_str]
 
-async def end_chat_session(user_id1_str: str, user_id2_str: str | None, context: ContextTypes.DEFAULT_TYPE, initiator_id_str: str, is_part_of_search: bool = False) -> None:
+async def end_chat_session(user_id1_str: str, user_id2_str: str | None, context: ContextTypes.DEFAULT_TYPE, initiator_id_str: str | None, is_part_of_search: bool = False, end_text: str | None = None) -> None:
     await process_post_chat_warnings(user_id1_str, context)
     if user_id2_str:
         await process_post_chat_warnings(user_id2_str, context)
     
+    session_id = None
     for uid_str in [user_id1_str, user_id2_str]:
         if uid_str:
             user_data = get_user(int(uid_str))
             if user_data:
+                session_id = session_id or user_data.get('current_chat_session')
                 user_data.update({'chat_status': CHAT_STATUS_IDLE, 'current_chat_partner': None, 'current_chat_session': None})
                 update_user(user_data)
+    cancel_timer(context, 'chat', session_id)
+    if session_id: close_chat_session(session_id)
     
     if is_part_of_search:
         partner_id_str = user_id2_str if initiator_id_str == user_id1_str else user_id1_str
@@ -317,23 +1666,23 @@ async def end_chat_session(user_id1_str: str, user_id2_str: str | None, context:
              try:
                 await context.bot.send_message(partner_id_str, "Суразмоўца пакінуў чат, каб знайсьці новага.\n\nКаб пачаць новы пошук, выкарыстоўвайце /search.")
              except Forbidden: mark_user_as_bot_blocker(partner_id_str)
-             except Exception as e: logger.error(f"Не атрымалася адправіць паведамленьне пра завяршэньне чата для {partner_id_str}: {e}")
+             except Exception as e: logger.error("Не атрымалася адправіць паведамленьне пра завяршэньне чата для %s: %s", partner_id_str, e)
         return
 
     for uid_str, partner_id_str in [(user_id1_str, user_id2_str), (user_id2_str, user_id1_str)]:
         if uid_str:
             try:
-                message_text = "Чат завершаны." if initiator_id_str == uid_str else "Суразмоўца завяршыў чат."
+                message_text = end_text or ("Чат завершаны." if initiator_id_str == uid_str else "Суразмоўца завяршыў чат.")
                 reply_markup = ADMIN_MAIN_MENU_KEYBOARD if is_admin(uid_str) else ReplyKeyboardRemove()
                 final_message_text = f"{message_text}\n\nКаб пачаць новы пошук, выкарыстоўвайце /search."
                 final_reply_markup = None
                 if partner_id_str and not is_admin(partner_id_str):
-                    final_reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Паскардзіцца на суразмоўцу", callback_data=f"report_{partner_id_str}")]])
+                    final_reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Паскардзіцца на суразмоўцу", callback_data=f"report_{partner_id_str}_{session_id or ''}")]])
                 await context.bot.send_message(uid_str, final_message_text, reply_markup=reply_markup)
                 if final_reply_markup:
                     await context.bot.send_message(uid_str, "Калі суразмоўца парушаў правілы, вы можаце паскардзіцца.", reply_markup=final_reply_markup)
             except Forbidden: mark_user_as_bot_blocker(uid_str)
-            except Exception as e: logger.error(f"Не атрымалася адправіць паведамленьне пра завяршэньне чата для {uid_str}: {e}")
+            except Exception as e: logger.error("Не атрымалася адправіць паведамленьне пра завяршэньне чата для %s: %s", uid_str, e)
 
 @check_if_banned
 async def stop_command(update: Update, context: ContextTypes.DEFAULT_TYPE, is_part_of_search: bool = False) -> None:
@@ -345,6 +1694,8 @@ async def stop_command(update: Update, context: ContextTypes.DEFAULT_TYPE, is_pa
     if status == CHAT_STATUS_WAITING:
         if user_id_str in context.bot_data.get('waiting_queue', []):
             context.bot_data['waiting_queue'].remove(user_id_str)
+        cancel_timer(context, 'search', user_id_str)
+        context.bot_data['search_started'].pop(user_id_str, None)
         user_data['chat_status'] = CHAT_STATUS_IDLE
         update_user(user_data)
         if not is_part_of_search: await update.message.reply_text("Пошук скасаваны.", reply_markup=reply_markup)
@@ -367,6 +1718,12 @@ async def chat_message_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     
     if not (partner_id and session_id): return
     partner_id_str = str(partner_id)
+    log_context.set({**log_context.get(), 'session_id': session_id})
+
+    track_chat_activity(context, session_id, user_id_str, partner_id_str)
+    if update.message.media_group_id:
+        buffer_media_group_message(context, user_id_str, partner_id_str, session_id, update.message)
+        return
 
     log_chat_message(user_id_str, partner_id_str, update.message, session_id)
     if update.message.text and any(char in FORBIDDEN_CHARS for char in update.message.text):
@@ -375,28 +1732,35 @@ async def chat_message_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     try:
         sent_message = await forward_message_with_reply(context, user_id_str, partner_id_str, update.message)
         if sent_message:
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute("INSERT INTO message_links (source_chat_id, source_message_id, dest_chat_id, dest_message_id) VALUES (%s, %s, %s, %s) ON CONFLICT DO NOTHING",
-                                (int(user_id_str), update.message.message_id, int(partner_id_str), sent_message.message_id))
-                    cur.execute("INSERT INTO message_links (source_chat_id, source_message_id, dest_chat_id, dest_message_id) VALUES (%s, %s, %s, %s) ON CONFLICT DO NOTHING",
-                                (int(partner_id_str), sent_message.message_id, int(user_id_str), update.message.message_id))
+            save_message_links(int(user_id_str), int(partner_id_str), [(update.message.message_id, sent_message.message_id)])
+            remember_relayed_message(context, update.message, sent_message)
     except Forbidden:
         mark_user_as_bot_blocker(partner_id_str)
         reply_markup_after_error = ADMIN_MAIN_MENU_KEYBOARD if is_admin(user_id_str) else ReplyKeyboardRemove()
         await end_chat_session(user_id_str, partner_id_str, context, initiator_id_str=user_id_str)
         await update.message.reply_text("❌ Не атрымалася даставіць паведамленьне. Суразмоўца, магчыма, заблякаваў бота. Чат завершаны.", reply_markup=reply_markup_after_error)
-    except Exception as e: logger.error(f"Памылка перасылкі: {e}")
+    except Exception as e: logger.error("Памылка перасылкі: %s", e)
+
+def get_message_link(source_chat_id: int, source_message_id: int) -> tuple[int, int] | None:
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT dest_chat_id, dest_message_id FROM message_links WHERE source_chat_id = %s AND source_message_id = %s",
+                        (source_chat_id, source_message_id))
+            result = cur.fetchone()
+            return tuple(result) if result else None
+
+def get_reply_dest_id(from_id_str: str, message: Update.message) -> int | None:
+    if not message.reply_to_message: return None
+    try:
+        link = get_message_link(int(from_id_str), message.reply_to_message.message_id)
+    except DB_CONNECTION_ERRORS as e:
+        if not is_connection_lost(e): raise
+        # Без БД сообщение всё равно доставляется, только без цитаты
+        return None
+    return link[1] if link else None
 
 async def forward_message_with_reply(context: ContextTypes.DEFAULT_TYPE, from_id_str: str, to_id_str: str, message: Update.message):
-    reply_to_dest_id = None
-    if message.reply_to_message:
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT dest_message_id FROM message_links WHERE source_chat_id = %s AND source_message_id = %s",
-                                      (int(from_id_str), message.reply_to_message.message_id))
-                result = cur.fetchone()
-                if result: reply_to_dest_id = result[0]
+    reply_to_dest_id = get_reply_dest_id(from_id_str, message)
     kwargs = {'chat_id': to_id_str, 'reply_to_message_id': reply_to_dest_id}
     if message.text: return await context.bot.send_message(text=message.text, entities=message.entities, **kwargs)
     elif message.photo: return await context.bot.send_photo(photo=message.photo[-1].file_id, caption=message.caption, caption_entities=message.caption_entities, **kwargs)
@@ -408,34 +1772,141 @@ async def forward_message_with_reply(context: ContextTypes.DEFAULT_TYPE, from_id
     elif message.audio: return await context.bot.send_audio(audio=message.audio.file_id, caption=message.caption, caption_entities=message.caption_entities, **kwargs)
     else: return await message.copy(chat_id=to_id_str, reply_to_message_id=reply_to_dest_id)
 
+# --- АЛЬБОМЫ (MEDIA GROUP) ---
+
+def to_input_media(message: Update.message):
+    kwargs = {'caption': message.caption, 'caption_entities': message.caption_entities}
+    if message.photo: return InputMediaPhoto(media=message.photo[-1].file_id, **kwargs)
+    if message.video: return InputMediaVideo(media=message.video.file_id, **kwargs)
+    if message.document: return InputMediaDocument(media=message.document.file_id, **kwargs)
+    if message.audio: return InputMediaAudio(media=message.audio.file_id, **kwargs)
+    return None
+
+def buffer_media_group_message(context: ContextTypes.DEFAULT_TYPE, user_id_str: str, partner_id_str: str, session_id: str, message: Update.message):
+    # Telegram присылает альбом отдельными апдейтами с общим media_group_id;
+    # копим их, пока не пройдёт MEDIA_GROUP_WINDOW без новых частей, и шлём одним send_media_group.
+    media_groups = context.bot_data.setdefault('media_groups', {})
+    group_key = (user_id_str, message.media_group_id)
+    group = media_groups.get(group_key)
+    if group is None:
+        group = media_groups[group_key] = {'partner_id': partner_id_str, 'session_id': session_id, 'messages': [], 'last_seen': 0.0}
+        context.application.create_task(flush_media_group(context, group_key), name=f"media_group_{message.media_group_id}")
+    group['messages'].append(message)
+    group['last_seen'] = time.monotonic()
+
+async def flush_media_group(context: ContextTypes.DEFAULT_TYPE, group_key: tuple[str, str]):
+    media_groups = context.bot_data['media_groups']
+    while (delay := media_groups[group_key]['last_seen'] + MEDIA_GROUP_WINDOW - time.monotonic()) > 0:
+        await asyncio.sleep(delay)
+    group = media_groups.pop(group_key)
+    user_id_str, partner_id_str = group_key[0], group['partner_id']
+    # За время ожидания отправитель мог выйти из чата (/stop, /search): альбом бывшему собеседнику не шлём
+    user_data = get_user(int(user_id_str))
+    if not user_data or user_data.get('current_chat_session') != group['session_id'] or str(user_data.get('current_chat_partner')) != partner_id_str:
+        return
+    messages = sorted(group['messages'], key=lambda m: m.message_id)
+
+    log_chat_messages(user_id_str, partner_id_str, messages, group['session_id'])
+    try:
+        media = [to_input_media(m) for m in messages]
+        if len(messages) < 2 or None in media:
+            sent_messages = [await forward_message_with_reply(context, user_id_str, partner_id_str, m) for m in messages]
+        else:
+            reply_to_dest_id = get_reply_dest_id(user_id_str, messages[0])
+            sent_messages = []
+            for i in range(0, len(media), MEDIA_GROUP_MAX_SIZE):
+                sent_messages.extend(await context.bot.send_media_group(partner_id_str, media=media[i:i + MEDIA_GROUP_MAX_SIZE], reply_to_message_id=reply_to_dest_id))
+        save_message_links(int(user_id_str), int(partner_id_str),
+                           [(m.message_id, sent.message_id) for m, sent in zip(messages, sent_messages) if sent])
+        for m, sent in zip(messages, sent_messages):
+            if sent: remember_relayed_message(context, m, sent)
+    except Forbidden:
+        mark_user_as_bot_blocker(partner_id_str)
+        reply_markup_after_error = ADMIN_MAIN_MENU_KEYBOARD if is_admin(user_id_str) else ReplyKeyboardRemove()
+        await end_chat_session(user_id_str, partner_id_str, context, initiator_id_str=user_id_str)
+        await context.bot.send_message(user_id_str, "❌ Не атрымалася даставіць паведамленьне. Суразмоўца, магчыма, заблякаваў бота. Чат завершаны.", reply_markup=reply_markup_after_error)
+    except Exception as e: logger.error("Памылка перасылкі альбома: %s", e)
+
+# --- ПРАВКИ СООБЩЕНИЙ ---
+
+def message_content(message: Update.message) -> tuple[str | None, list[dict]]:
+    if message.text is not None:
+        return message.text, [e.to_dict() for e in message.entities or ()]
+    return message.caption, [e.to_dict() for e in message.caption_entities or ()]
+
+def remember_relayed_message(context: ContextTypes.DEFAULT_TYPE, message: Update.message, sent_message: Update.message):
+    # Куда переслано сообщение и в каком виде: правки не ходят в БД за ссылкой и пропускают повторы без изменений
+    relayed = context.bot_data['relayed_messages']
+    key = (message.chat_id, message.message_id)
+    relayed[key] = {'dest_chat_id': sent_message.chat_id, 'dest_message_id': sent_message.message_id, 'content': message_content(message)}
+    relayed.move_to_end(key)
+    while len(relayed) > RELAYED_MESSAGES_CACHE_SIZE:
+        relayed.popitem(last=False)
+
 @check_if_banned
 async def edited_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Серия правок одного сообщения (исправление опечаток) сливается в одну:
+    # пересылается последняя версия, когда EDIT_DEBOUNCE_WINDOW проходит без новых правок.
     edited_message = update.edited_message
     if not edited_message: return
+    pending_edits = context.bot_data['pending_edits']
+    key = (edited_message.chat_id, edited_message.message_id)
+    edit = pending_edits.get(key)
+    if edit is None:
+        edit = pending_edits[key] = {'message': edited_message, 'last_seen': 0.0}
+        context.application.create_task(flush_message_edit(context, key), name=f"edit_{key[0]}_{key[1]}")
+    elif edited_message.edit_date and edit['message'].edit_date and edited_message.edit_date < edit['message'].edit_date:
+        return
+    edit['message'] = edited_message
+    edit['last_seen'] = time.monotonic()
+
+async def flush_message_edit(context: ContextTypes.DEFAULT_TYPE, key: tuple[int, int]):
+    pending_edits = context.bot_data['pending_edits']
+    while (delay := pending_edits[key]['last_seen'] + EDIT_DEBOUNCE_WINDOW - time.monotonic()) > 0:
+        await asyncio.sleep(delay)
+    edited_message = pending_edits.pop(key)['message']
+    user_data = get_user(key[0])
+    if not user_data or not user_data.get('current_chat_partner'): return
+    content = message_content(edited_message)
+    text = content[0]
+    if text is None: return
+
+    relayed = context.bot_data['relayed_messages'].get(key)
+    if relayed is None:
+        try:
+            link = get_message_link(*key)
+        except DB_CONNECTION_ERRORS as e:
+            if not is_connection_lost(e): raise
+            return  # без БД не узнать, куда ушло сообщение: правку пропускаем
+        if not link: return
+        dest_chat_id, dest_message_id = link
+    elif relayed['content'] == content:
+        return
+    else:
+        dest_chat_id, dest_message_id = relayed['dest_chat_id'], relayed['dest_message_id']
 
-    user_id = edited_message.chat_id
-    user_data = get_user(user_id)
-    if not user_data or not (partner_id := user_data.get('current_chat_partner')): return
+    try:
+        if edited_message.text is not None:
+            sent_message = await context.bot.edit_message_text(chat_id=dest_chat_id, message_id=dest_message_id, text=text, entities=edited_message.entities)
+        else:
+            sent_message = await context.bot.edit_message_caption(chat_id=dest_chat_id, message_id=dest_message_id, caption=text, caption_entities=edited_message.caption_entities)
+    except BadRequest as e:
+        if "message is not modified" not in str(e).lower(): logger.error("Памылка рэдагаваньня (BadRequest): %s", e)
+        return
+    except Exception as e:
+        logger.error("Невядомая памылка рэдагаваньня: %s", e)
+        return
+    if isinstance(sent_message, Message): remember_relayed_message(context, edited_message, sent_message)
+    context.bot_data['edit_log_buffer'][key] = text
 
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT dest_message_id FROM message_links WHERE source_chat_id = %s AND source_message_id = %s",
-                          (user_id, edited_message.message_id))
-            result = cur.fetchone()
-            if result:
-                dest_message_id = result[0]
-                try:
-                    if edited_message.text:
-                        await context.bot.edit_message_text(chat_id=partner_id, message_id=dest_message_id, text=edited_message.text, entities=edited_message.entities)
-                        cur.execute("UPDATE chat_logs SET message_text = %s WHERE sender_id = %s AND message_id = %s",
-                                     (edited_message.text, user_id, edited_message.message_id))
-                    elif edited_message.caption is not None:
-                        await context.bot.edit_message_caption(chat_id=partner_id, message_id=dest_message_id, caption=edited_message.caption, caption_entities=edited_message.caption_entities)
-                        cur.execute("UPDATE chat_logs SET message_text = %s WHERE sender_id = %s AND message_id = %s",
-                                     (edited_message.caption, user_id, edited_message.message_id))
-                except BadRequest as e:
-                    if "message is not modified" not in str(e).lower(): logger.error(f"Памылка рэдагаваньня (BadRequest): {e}")
-                except Exception as e: logger.error(f"Невядомая памылка рэдагаваньня: {e}")
+def drain_edit_log_buffer(bot_data: dict) -> list[tuple[int, int, str]]:
+    buffer, bot_data['edit_log_buffer'] = bot_data['edit_log_buffer'], {}
+    return [(sender_id, message_id, text) for (sender_id, message_id), text in buffer.items()]
+
+async def flush_edit_log_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Тексты правок копятся и пишутся в chat_messages одним UPDATE за интервал
+    rows = drain_edit_log_buffer(context.bot_data)
+    if rows: await asyncio.to_thread(write_or_spool, 'edits', rows)
 
 # --- АДМІНІСТРАВАНЬНЕ ---
 
@@ -463,13 +1934,15 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
                  "<b>📣 Рассылкі</b> - адпраўка паведамленьняў усім ці выбраным карыстальнікам.\n"
                  "<b>🆘 SOS-чаты</b> - пачаць чат з карыстальнікам з чаргі SOS.\n"
                  "<b>💬 Выпадковы чат</b> - увайсьці ў ананімны чат як звычайны карыстальнік.\n"
-                 "<b>⚙️ Сыстэма</b> - дадатковыя наладкі, напрыклад, ачыстка базы зьвестак.")
+                 "<b>⚙️ Сыстэма</b> - дадатковыя наладкі: ачыстка базы зьвестак, прафіляваньне (/profile СЕКУНДЫ).\n"
+                 "<b>/find</b> - пошук па тэксьце ўсіх перапісак (фільтры user:, session:, from:, to:).\n"
+                 "<b>/trends</b> - трэнды па тыднях: актыўнасьць, чаты, чаканьне, баны (/trends ТЫДНІ).")
     await update.message.reply_text(help_text, parse_mode=ParseMode.HTML)
 
 @check_if_banned
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        with get_db_connection() as conn:
+        with get_replica_connection() as conn:
             with conn.cursor(cursor_factory=DictCursor) as cur:
                 cur.execute("SELECT COUNT(DISTINCT session_id) as total_sessions, COUNT(log_id) as total_messages FROM chat_logs")
                 chat_stats = cur.fetchone()
@@ -509,7 +1982,7 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                       f"  - Uptime: `{d}д {h}г {m}хв`")
         await update.message.reply_text(stats_text, parse_mode=ParseMode.MARKDOWN)
     except Exception as e:
-        logger.error(f"Памылка пры атрыманьні статыстыкі: {e}")
+        logger.error("Памылка пры атрыманьні статыстыкі: %s", e)
         await update.message.reply_text(f"❌ Адбылася памылка пры атрыманьні статыстыкі: {e}")
 
 @check_if_banned
@@ -580,13 +2053,14 @@ async def admin_ban_unban_user(update: Update, context: ContextTypes.DEFAULT_TYP
         user_data['is_banned'] = (action == 'ban')
         if action == 'unban': user_data['warnings'] = 0
         update_user(user_data)
+        record_user_event(user_data['user_id'], action)
         await get_user_info_receive(update, context, user_id_to_get=user_id_str)
 
 async def admin_show_chat_partners(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
     user_id_str = query.data.split('_')[-1]
-    with get_db_connection() as conn:
+    with get_replica_connection() as conn:
         with conn.cursor() as cur:
             cur.execute("""
                 SELECT DISTINCT partner_id FROM chat_logs WHERE sender_id = %s
@@ -609,7 +2083,7 @@ async def admin_list_sessions(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     await query.answer()
     _, _, user1_id, user2_id = query.data.split('_')
-    with get_db_connection() as conn:
+    with get_replica_connection() as conn:
         with conn.cursor() as cur:
             cur.execute("""
                 SELECT session_id, MIN(timestamp) as start_time FROM chat_logs
@@ -639,7 +2113,7 @@ async def admin_view_specific_chat(update: Update, context: ContextTypes.DEFAULT
     await query.answer("Загружаю гісторыю...")
     session_id = query.data.removeprefix('view_session_')
     
-    with get_db_connection() as conn:
+    with get_replica_connection() as conn:
         with conn.cursor(cursor_factory=DictCursor) as cur:
             cur.execute("SELECT * FROM chat_logs WHERE session_id = %s ORDER BY log_id ASC", (session_id,))
             chat_history = cur.fetchall()
@@ -682,18 +2156,94 @@ async def admin_view_specific_chat(update: Update, context: ContextTypes.DEFAULT
                     await context.bot.send_video_note(ADMIN_CHAT_ID, file_id)
             await asyncio.sleep(0.3)
         except Exception as e:
-            logger.error(f"Немагчыма адправіць паведамленьне з гісторыі: {e}")
+            logger.error("Немагчыма адправіць паведамленьне з гісторыі: %s", e)
             await context.bot.send_message(ADMIN_CHAT_ID, f"{sender_header} [Паведамленьне ня можа быць паказана. Памылка: {e}]")
 
     await context.bot.send_message(ADMIN_CHAT_ID, "--- Канец перапіскі ---")
 
+# --- ПОШУК ПА ГІСТОРЫІ ---
+
+TEXT_SEARCH_USAGE = ("Выкарыстаньне: <code>/find словы для пошуку [user:ID|@username] [session:ID] [from:ГГГГ-ММ-ДД] [to:ГГГГ-ММ-ДД]</code>\n\n"
+                     "Падтрымліваюцца «фразы ў двукосьсі», OR і -выключэньне.")
+
+def parse_text_search_args(args: list[str]) -> dict | None:
+    search = {'query': [], 'user_id': None, 'session_id': None, 'date_from': None, 'date_to': None}
+    for arg in args:
+        key, _, value = arg.partition(':')
+        if key == 'user' and value:
+            search['user_id'] = find_user_id_by_identifier(value)
+            if not search['user_id']: return None
+        elif key == 'session' and value:
+            search['session_id'] = value
+        elif key in ('from', 'to') and value:
+            try: datetime.date.fromisoformat(value)
+            except ValueError: return None
+            search['date_from' if key == 'from' else 'date_to'] = value
+        else:
+            search['query'].append(arg)
+    search['query'] = ' '.join(search['query'])
+    return search if search['query'] else None
+
+async def send_text_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE, token: str, before_log_id: int | None, page: int) -> None:
+    search = context.user_data.get('text_searches', {}).get(token)
+    target = update.callback_query.edit_message_text if update.callback_query else update.message.reply_text
+    if not search:
+        await target("Пошук састарэў. Паўтарыце каманду /find.")
+        return
+    rows = await asyncio.to_thread(search_chat_logs, search['query'], search['user_id'], search['session_id'],
+                                   datetime.date.fromisoformat(search['date_from']) if search['date_from'] else None,
+                                   datetime.date.fromisoformat(search['date_to']) if search['date_to'] else None,
+                                   before_log_id, TEXT_SEARCH_PAGE_SIZE + 1)
+    has_next = len(rows) > TEXT_SEARCH_PAGE_SIZE
+    rows = rows[:TEXT_SEARCH_PAGE_SIZE]
+    if not rows:
+        await target(f"🔎 Па запыце «{html.escape(search['query'])}» нічога ня знойдзена.", parse_mode=ParseMode.HTML)
+        return
+    lines = [f"🔎 Вынікі па запыце «{html.escape(search['query'])}», старонка {page}:"]
+    for i, row in enumerate(rows, 1):
+        text = row['message_text'] or ''
+        if len(text) > 200: text = text[:197] + "..."
+        lines.append(f"<b>{i}.</b> {row['timestamp'].strftime('%Y-%m-%d %H:%M')} <code>{row['sender_id']}</code> → <code>{row['partner_id']}</code> [{row['message_type']}]\n{html.escape(text)}")
+    session_buttons = [InlineKeyboardButton(f"📜 {i}", callback_data=f"view_session_{row['session_id']}") for i, row in enumerate(rows, 1)]
+    buttons = [session_buttons[i:i + 5] for i in range(0, len(session_buttons), 5)]
+    if has_next:
+        buttons.append([InlineKeyboardButton("Далей ▶️", callback_data=f"find_page_{token}_{rows[-1]['log_id']}_{page + 1}")])
+    await target("\n\n".join(lines), parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup(buttons))
+
+@check_if_banned
+async def admin_text_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    search = parse_text_search_args(context.args or [])
+    if not search:
+        await update.message.reply_text(TEXT_SEARCH_USAGE, parse_mode=ParseMode.HTML)
+        return
+    searches = context.user_data.setdefault('text_searches', {})
+    while len(searches) >= TEXT_SEARCH_SAVED_QUERIES:
+        searches.pop(next(iter(searches)))
+    token = uuid.uuid4().hex[:8]
+    searches[token] = search
+    try:
+        await send_text_search_page(update, context, token, None, 1)
+    except Exception as e:
+        logger.error("Памылка пошуку па гісторыі: %s", e)
+        await update.message.reply_text(f"❌ Памылка пошуку: {e}")
+
+async def admin_text_search_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    _, _, token, before_log_id, page = query.data.split('_')
+    try:
+        await send_text_search_page(update, context, token, int(before_log_id), int(page))
+    except Exception as e:
+        logger.error("Памылка пошуку па гісторыі: %s", e)
+
 # --- ЛОГИКА СКАРГАЎ ---
 
 async def report_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     reporter_id = str(query.from_user.id)
-    reported_id = query.data.split('_')[1]
-    buttons = [[InlineKeyboardButton("Так, паскардзіцца", callback_data=f"confirm_report_{reporter_id}_{reported_id}")],
+    _, reported_id, *rest = query.data.split('_', 2)
+    session_id = rest[0] if rest else ''
+    buttons = [[InlineKeyboardButton("Так, паскардзіцца", callback_data=f"confirm_report_{reporter_id}_{reported_id}_{session_id}")],
                [InlineKeyboardButton("Не, скасаваць", callback_data="cancel_report")]]
     await query.answer()
     await query.edit_message_text("Вы ўпэўненыя, што хочаце паскардзіцца на гэтага суразмоўцу?", reply_markup=InlineKeyboardMarkup(buttons))
@@ -701,8 +2251,9 @@ async def report_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def confirm_report_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    _, _, reporter_id, reported_id = query.data.split('_')
-    context.user_data['report_data'] = {'reporter_id': reporter_id, 'reported_id': reported_id, 'screenshots': []}
+    _, _, reporter_id, reported_id, *rest = query.data.split('_', 4)
+    session_id = rest[0] if rest and rest[0] else None
+    context.user_data['report_data'] = {'reporter_id': reporter_id, 'reported_id': reported_id, 'session_id': session_id, 'screenshots': []}
     await query.edit_message_text("Калі ласка, дашліце адно або некалькі фота (скрыншотаў) зь перапіскі, якія пацьвярджаюць парушэньне.\n\n"
                                   "Пасьля таго, як дашлеце ўсе файлы, націсьніце кнопку **'Гатова'**.",
                                   reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✅ Гатова", callback_data="finish_report")]]))
@@ -722,8 +2273,9 @@ async def finish_report_callback(update: Update, context: ContextTypes.DEFAULT_T
     report_data = context.user_data.get('report_data', {})
     reporter_id = report_data.get('reporter_id')
     reported_id = report_data.get('reported_id')
+    session_id = report_data.get('session_id')
     screenshots = report_data.get('screenshots', [])
-    if not (reporter_id and reported_id and screenshots):
+    if not (reporter_id and reported_id and (screenshots or session_id)):
         await query.edit_message_text("❌ Памылка. Скарга ня будзе адпраўленая. Паспрабуйце зноў.")
         context.user_data.pop('report_data', None)
         return ConversationHandler.END
@@ -733,16 +2285,55 @@ async def finish_report_callback(update: Update, context: ContextTypes.DEFAULT_T
     reported_name = get_user_display_name(reported_id, users_db)
     report_text = (f"❗️ **Новая скарга!**\n\n"
                    f"**Ад:** `{reporter_name}` (ID: `{reporter_id}`)\n"
-                   f"**На:** `{reported_name}` (ID: `{reported_id}`)\n\n"
+                   f"**На:** `{reported_name}` (ID: `{reported_id}`)\n"
+                   f"**Сэсія:** `{session_id or 'невядомая'}`\n\n"
                    f"Адміністратар, праверце прыкладзеныя доказы.")
     await context.bot.send_message(ADMIN_CHAT_ID, report_text, parse_mode=ParseMode.MARKDOWN)
     media_group = [InputMediaPhoto(media=ss) for ss in screenshots]
     if media_group:
         await context.bot.send_media_group(ADMIN_CHAT_ID, media=media_group)
+    if session_id:
+        context.application.create_task(send_report_transcript(context, session_id, reporter_id, reported_id), name="report_transcript")
     await query.edit_message_text("✅ Дзякуй! Вашая скарга адпраўлена адміністратару.")
     context.user_data.pop('report_data', None)
     return ConversationHandler.END
 
+def get_session_excerpt(session_id: str, limit: int = REPORT_TRANSCRIPT_LIMIT) -> list[dict]:
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute("SELECT timestamp, sender_id, message_type, message_text, file_id FROM chat_logs WHERE session_id = %s ORDER BY log_id DESC LIMIT %s",
+                        (session_id, limit))
+            return [dict(row) for row in reversed(cur.fetchall())]
+
+def render_session_excerpt(session_id: str, rows: list[dict], names: dict[str, str]) -> str:
+    lines = [f"Сэсія {session_id}: апошнія {len(rows)} паведамленьняў", ""]
+    for row in rows:
+        sender_id = str(row['sender_id'])
+        prefix = f"[{row['timestamp'].strftime('%Y-%m-%d %H:%M:%S')}] {names.get(sender_id, sender_id)} ({sender_id}):"
+        if row['message_type'] == 'text':
+            lines.append(f"{prefix} {row['message_text']}")
+        else:
+            caption = f" {row['message_text']}" if row['message_text'] else ""
+            lines.append(f"{prefix} [{row['message_type']}]{caption} (file_id: {row['file_id']})")
+    return "\n".join(lines)
+
+async def send_report_transcript(context: ContextTypes.DEFAULT_TYPE, session_id: str, reporter_id: str, reported_id: str) -> None:
+    try:
+        rows = await asyncio.to_thread(get_session_excerpt, session_id)
+        if not rows:
+            await context.bot.send_message(ADMIN_CHAT_ID, f"Гісторыя сэсіі `{session_id}` пустая або ўжо выдаленая.", parse_mode=ParseMode.MARKDOWN)
+            return
+        names = {}
+        for uid in (reporter_id, reported_id):
+            user_data = get_user(int(uid))
+            names[uid] = (user_data or {}).get('first_name') or f"User {uid}"
+        transcript = render_session_excerpt(session_id, rows, names)
+        await context.bot.send_document(ADMIN_CHAT_ID, document=InputFile(transcript.encode('utf-8'), filename=f"report_{session_id}.txt"),
+                                        caption=f"📄 Урывак перапіскі да скаргі на `{reported_id}` (сэсія `{session_id}`)", parse_mode=ParseMode.MARKDOWN,
+                                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📜 Уся сэсія", callback_data=f"view_session_{session_id}")]]))
+    except Exception as e:
+        logger.error("Не атрымалася сабраць урывак перапіскі для скаргі (сэсія %s): %s", session_id, e)
+
 async def cancel_report_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
@@ -773,7 +2364,7 @@ async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE)
             mark_user_as_bot_blocker(user_id_str)
             failed += 1
         except Exception as e:
-            logger.error(f"Не атрымалася адправіць паведамленьне {user_id_str} падчас рассылкі: {e}")
+            logger.error("Не атрымалася адправіць паведамленьне %s падчас рассылкі: %s", user_id_str, e)
             failed += 1
     await update.message.reply_text(f"✅ Рассылка завершаная!\n👍 Адпраўлена: {sent}\n👎 Не атрымалася: {failed}", reply_markup=ADMIN_BROADCAST_MENU_KEYBOARD)
     return ConversationHandler.END
@@ -827,7 +2418,7 @@ async def contact_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Усяго ў чарзе: **{len(sos_queue)}**.\n\n"
             f"Націсьніце '🆘 SOS-чаты', каб пачаць.", parse_mode=ParseMode.MARKDOWN)
     except Exception as e:
-        logger.error(f"Немагчыма адправіць SOS апавяшчэньне адміну: {e}")
+        logger.error("Немагчыма адправіць SOS апавяшчэньне адміну: %s", e)
 
 @check_if_banned
 async def admin_sos_chat_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -855,7 +2446,7 @@ async def admin_sos_chat_start(update: Update, context: ContextTypes.DEFAULT_TYP
     try:
         await context.bot.send_message(user_id_to_connect, "Адміністратар падключаецца да вас...")
     except Exception as e:
-        logger.error(f"Немагчыма апавясьціць {user_id_to_connect} пра падключэньне адміна: {e}")
+        logger.error("Немагчыма апавясьціць %s пра падключэньне адміна: %s", user_id_to_connect, e)
     await connect_users(str(admin_id), str(user_id_to_connect), context)
 
 async def handle_amnesty_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -865,8 +2456,37 @@ async def handle_amnesty_code(update: Update, context: ContextTypes.DEFAULT_TYPE
         user_data['is_banned'] = False
         user_data['warnings'] = 0
         update_user(user_data)
+        record_user_event(user_id, 'unban')
         await update.message.reply_text("✅ Ваш доступ адноўлены. Калі ласка, надалей карыстайцеся выключна літарамі беларускага альфабэту.", reply_markup=ReplyKeyboardRemove())
-        logger.info(f"Карыстальнік {user_id} выкарыстаў код амністыі і быў разбанены.")
+        logger.info("Карыстальнік %s выкарыстаў код амністыі і быў разбанены.", user_id)
+
+@check_if_banned
+async def admin_profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    monitor = context.bot_data.get('loop_monitor')
+    if not monitor:
+        await update.message.reply_text("Прафайлер яшчэ не запушчаны, паспрабуйце пазьней.")
+        return
+    if monitor.profile is not None:
+        await update.message.reply_text("Прафіляваньне ўжо ідзе, пачакайце вынікаў.")
+        return
+    seconds = int(context.args[0]) if context.args and context.args[0].isdigit() else PROFILER_DEFAULT_SECONDS
+    seconds = min(max(seconds, 1), PROFILER_MAX_SECONDS)
+    await update.message.reply_text(f"🔬 Прафіляваньне запушчана на {seconds} с. Вынік прыйдзе сюды.")
+    context.application.create_task(run_and_send_profile(context, seconds), name="admin_profile")
+
+async def admin_trends_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    weeks = int(context.args[0]) if context.args and context.args[0].isdigit() else TRENDS_DEFAULT_WEEKS
+    weeks = min(max(weeks, 1), TRENDS_MAX_WEEKS)
+    try:
+        trends = await asyncio.to_thread(load_trends, weeks)
+    except Exception as e:
+        logger.error("Памылка пры атрыманьні трэндаў: %s", e)
+        await update.message.reply_text(f"❌ Адбылася памылка пры атрыманьні трэндаў: {e}")
+        return
+    if not trends['weeks']:
+        await update.message.reply_text("Зводкі яшчэ пустыя: яны абнаўляюцца раз на некалькі хвілінаў.")
+        return
+    await update.message.reply_text(f"<pre>{html.escape(render_trends(trends))}</pre>", parse_mode=ParseMode.HTML)
 
 async def clear_chat_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     buttons = [[InlineKeyboardButton("Так, я ўпэўнены, выдаліць усё", callback_data="confirm_clear_history")],
@@ -881,11 +2501,12 @@ async def confirm_clear_history_callback(update: Update, context: ContextTypes.D
     try:
         with get_db_connection() as conn:
             with conn.cursor() as cur:
-                cur.execute("TRUNCATE TABLE chat_logs, message_links;")
+                # chat_sessions не трогаем: на них ссылаются текущие активные чаты
+                cur.execute("TRUNCATE TABLE chat_messages, chat_logs_legacy, media_files, message_links;")
         logger.warning("Адміністратар ачысьціў усю гісторыю чатаў.")
         await query.edit_message_text("✅ Уся гісторыя перапісак пасьпяхова выдаленая.")
     except Exception as e:
-        logger.error(f"Памылка пры ачыстцы гісторыі: {e}")
+        logger.error("Памылка пры ачыстцы гісторыі: %s", e)
         await query.edit_message_text(f"❌ Адбылася памылка пры ачыстцы гісторыі: {e}")
 
 async def cancel_clear_history_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -893,7 +2514,35 @@ async def cancel_clear_history_callback(update: Update, context: ContextTypes.DE
     await query.answer()
     await query.edit_message_text("Ачыстка гісторыі скасаваная.")
 
+async def recover_user_states_on_startup(application: Application):
+    try:
+        broken_ids, waiting_ids, active_chats = await asyncio.to_thread(load_user_states_to_recover)
+    except Exception as e:
+        logger.error("Не удалось восстановить статусы пользователей после перезапуска: %s", e)
+        return
+    pairs = []
+    async with application.bot_data['chat_search_lock']:
+        waiting_queue = application.bot_data.setdefault('waiting_queue', [])
+        recovered = [uid for uid in waiting_ids
+                     if uid not in waiting_queue and (get_user(int(uid)) or {}).get('chat_status') == CHAT_STATUS_WAITING]
+        waiting_queue[:0] = recovered
+        while len(waiting_queue) >= 2:
+            pairs.append((waiting_queue.pop(0), waiting_queue.pop(0)))
+    context = ContextTypes.DEFAULT_TYPE(application)
+    for session_id, user1_id_str, user2_id_str in active_chats:
+        track_chat_activity(context, session_id, user1_id_str, user2_id_str)
+    for user_id_str in waiting_queue:
+        track_search(context, user_id_str)
+    for user1_id_str, user2_id_str in pairs:
+        await connect_users(user1_id_str, user2_id_str, context)
+    logger.info("Восстановление после перезапуска: сброшено сломанных чатов %s, возвращено в очередь %s, соединено пар %s.", len(broken_ids), len(recovered), len(pairs))
+
 async def post_init(application: Application):
+    monitor = LoopMonitor(asyncio.get_running_loop())
+    monitor.start(application)
+    application.bot_data['loop_monitor'] = monitor
+    # Восстановление идёт параллельно с приёмом апдейтов и не задерживает старт
+    application.create_task(recover_user_states_on_startup(application), name="recover_user_states")
     await application.bot.set_my_commands([
         BotCommand("search", "🔎 Пачаць/наступны ананімны чат"),
         BotCommand("stop", "⏹️ Спыніць бягучы дыялёг"),
@@ -901,16 +2550,33 @@ async def post_init(application: Application):
         BotCommand("rules", "📜 Правілы чату"),
     ])
 
-def main() -> None:
-    initialize_databases()
-    reset_all_user_statuses_on_startup()
+async def post_shutdown(application: Application):
+    # Тексты правок, накопленные с последнего flush_edit_log_job, не должны потеряться при остановке
+    rows = drain_edit_log_buffer(application.bot_data)
+    if rows: await asyncio.to_thread(write_or_spool, 'edits', rows)
 
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+def build_application(token: str = BOT_TOKEN, base_url: str | None = None) -> Application:
+    builder = Application.builder().token(token).persistence(PostgresPersistence()).post_init(post_init).post_shutdown(post_shutdown)
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
 
     application.bot_data['start_time'] = datetime.datetime.utcnow()
     application.bot_data['sos_queue'] = []
     application.bot_data['waiting_queue'] = []
+    application.bot_data['search_started'] = {}
     application.bot_data['chat_search_lock'] = asyncio.Lock()
+    application.bot_data['timer_wheel'] = TimerWheel()
+    application.bot_data['pending_edits'] = {}
+    application.bot_data['relayed_messages'] = OrderedDict()
+    application.bot_data['edit_log_buffer'] = {}
+    application.job_queue.run_repeating(timer_wheel_tick_job, interval=TIMER_WHEEL_TICK, first=TIMER_WHEEL_TICK)
+    application.job_queue.run_repeating(rollup_job, interval=ROLLUP_INTERVAL, first=60)
+    application.job_queue.run_repeating(flush_edit_log_job, interval=EDIT_LOG_FLUSH_INTERVAL, first=EDIT_LOG_FLUSH_INTERVAL)
+    application.job_queue.run_repeating(db_spool_job, interval=DB_SPOOL_SYNC_INTERVAL, first=DB_SPOOL_SYNC_INTERVAL)
+    if DATABASE_REPLICA_URL:
+        application.job_queue.run_repeating(replica_check_job, interval=REPLICA_LAG_CHECK_INTERVAL, first=REPLICA_LAG_CHECK_INTERVAL)
+    application.job_queue.run_repeating(evict_idle_user_data_job, interval=max(PERSISTENCE_IDLE_TTL // 4, 60), first=PERSISTENCE_IDLE_TTL)
 
     admin_filter = filters.User(user_id=int(ADMIN_CHAT_ID))
     conv_fallbacks = [CommandHandler("cancel", cancel, filters=admin_filter)]
@@ -924,25 +2590,27 @@ def main() -> None:
             ]
         },
         fallbacks=[CallbackQueryHandler(cancel_report_callback, pattern=r'^cancel_report$')],
-        per_message=False
+        per_message=False,
+        name="report_conversation",
+        persistent=True
     )
     application.add_handler(report_handler)
 
     application.add_handler(ConversationHandler(
         entry_points=[MessageHandler(filters.Regex('^📣 Усім$') & admin_filter, sendall_start)],
         states={AWAITING_BROADCAST_MESSAGE: [MessageHandler(filters.ALL & ~filters.COMMAND, broadcast_message)]},
-        fallbacks=conv_fallbacks))
+        fallbacks=conv_fallbacks, name="sendall_conversation", persistent=True))
     application.add_handler(ConversationHandler(
         entry_points=[MessageHandler(filters.Regex('^🎯 Выбраным$') & admin_filter, sendto_start)],
         states={
             AWAITING_SENDTO_IDS: [MessageHandler(filters.TEXT & ~filters.COMMAND, sendto_receive_ids)],
             AWAITING_SENDTO_MESSAGE: [MessageHandler(filters.ALL & ~filters.COMMAND, sendto_receive_message)]
         },
-        fallbacks=conv_fallbacks))
+        fallbacks=conv_fallbacks, name="sendto_conversation", persistent=True))
     application.add_handler(ConversationHandler(
         entry_points=[MessageHandler(filters.Regex('^ℹ️ Інфо пра юзэра$') & admin_filter, get_user_info_start)],
         states={AWAITING_INFO_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_user_info_receive)]},
-        fallbacks=conv_fallbacks))
+        fallbacks=conv_fallbacks, name="user_info_conversation", persistent=True))
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("rules", rules_command))
@@ -950,6 +2618,9 @@ def main() -> None:
     application.add_handler(CommandHandler("search", search_command))
     application.add_handler(CommandHandler("stop", stop_command))
     application.add_handler(CommandHandler("help", help_command, filters=admin_filter))
+    application.add_handler(CommandHandler("find", admin_text_search, filters=admin_filter))
+    application.add_handler(CommandHandler("profile", admin_profile_command, filters=admin_filter))
+    application.add_handler(CommandHandler("trends", admin_trends_command, filters=admin_filter))
 
     application.add_handler(MessageHandler(filters.Regex('^📊 Статыстыка$') & admin_filter, stats))
     application.add_handler(MessageHandler(filters.Regex('^👥 Карыстальнікі$') & admin_filter, admin_users_menu))
@@ -959,6 +2630,7 @@ def main() -> None:
     application.add_handler(MessageHandler(filters.Regex('^📋 Сьпіс усіх$') & admin_filter, users_list))
     application.add_handler(MessageHandler(filters.Regex('^🆘 SOS-чаты$') & admin_filter, admin_sos_chat_start))
     application.add_handler(MessageHandler(filters.Regex('^🗑️ Ачысьціць гісторыю чатаў$') & admin_filter, clear_chat_history))
+    application.add_handler(MessageHandler(filters.Regex('^🔬 Прафіляваньне$') & admin_filter, admin_profile_command))
     application.add_handler(MessageHandler(filters.Regex('^💬 Выпадковы чат$') & admin_filter, admin_enter_random_chat))
 
     application.add_handler(CallbackQueryHandler(show_full_user_list_callback, pattern='^show_full_user_list$'))
@@ -966,6 +2638,7 @@ def main() -> None:
     application.add_handler(CallbackQueryHandler(get_user_info_receive, pattern=r'^back_to_user_info_'))
     application.add_handler(CallbackQueryHandler(admin_list_sessions, pattern=r'^list_sessions_'))
     application.add_handler(CallbackQueryHandler(admin_view_specific_chat, pattern=r'^view_session_'))
+    application.add_handler(CallbackQueryHandler(admin_text_search_page_callback, pattern=r'^find_page_'))
     application.add_handler(CallbackQueryHandler(admin_ban_unban_user, pattern=r'^(un)?ban_'))
     application.add_handler(CallbackQueryHandler(report_callback, pattern=r'^report_'))
     application.add_handler(CallbackQueryHandler(cancel_report_callback, pattern=r'^cancel_report$'))
@@ -975,6 +2648,12 @@ def main() -> None:
     application.add_handler(MessageHandler(filters.UpdateType.EDITED_MESSAGE & filters.ChatType.PRIVATE & ~filters.COMMAND, edited_message_handler), group=1)
     application.add_handler(MessageHandler(filters.ChatType.PRIVATE & ~filters.COMMAND, chat_message_handler), group=1)
 
+    return application
+
+def main() -> None:
+    initialize_databases()
+
+    application = build_application()
     print("Бот пасьпяхова запушчаны...")
     application.run_polling()
 
@@ -0,0 +1,84 @@
+import argparse
+import logging
+import time
+
+import anonymous_chat_bot as bot
+
+# Онлайн-перенос истории из chat_logs_legacy в компактную chat_messages (миграция 5).
+# Каждая пачка переносится одной транзакцией: строки вставляются с прежним log_id и сразу
+# удаляются из legacy, так что представление chat_logs всё время видит каждую строку ровно один раз.
+#
+#   python backfill_chat_logs.py --batch-size 5000 --sleep 0.2
+#   python backfill_chat_logs.py --finalize     # после переноса: убрать legacy из представления
+
+logger = logging.getLogger("backfill_chat_logs")
+
+
+def backfill_batch(after_log_id: int, batch_size: int) -> tuple[int, int]:
+    with bot.get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT log_id FROM chat_logs_legacy WHERE log_id > %s ORDER BY log_id LIMIT %s FOR UPDATE SKIP LOCKED",
+                        (after_log_id, batch_size))
+            log_ids = [row[0] for row in cur.fetchall()]
+            if not log_ids: return 0, after_log_id
+            cur.execute("INSERT INTO chat_sessions (session_id) SELECT DISTINCT session_id FROM chat_logs_legacy WHERE log_id = ANY(%s) ON CONFLICT DO NOTHING",
+                        (log_ids,))
+            cur.execute("INSERT INTO media_files (file_id) SELECT DISTINCT file_id FROM chat_logs_legacy WHERE log_id = ANY(%s) AND file_id IS NOT NULL ON CONFLICT DO NOTHING",
+                        (log_ids,))
+            cur.execute("""
+                INSERT INTO chat_messages (log_id, session_key, timestamp, sender_id, partner_id, message_id, media_id, message_type, message_text)
+                SELECT l.log_id, s.session_key, COALESCE(l.timestamp, NOW()), l.sender_id, l.partner_id, l.message_id, f.media_id,
+                       COALESCE(t.type_id, 0), l.message_text
+                FROM chat_logs_legacy l
+                JOIN chat_sessions s ON s.session_id = l.session_id
+                LEFT JOIN media_files f ON f.file_id = l.file_id
+                LEFT JOIN message_types t ON t.name = l.message_type
+                WHERE l.log_id = ANY(%s)
+            """, (log_ids,))
+            cur.execute("DELETE FROM chat_logs_legacy WHERE log_id = ANY(%s)", (log_ids,))
+    return len(log_ids), log_ids[-1]
+
+
+def finalize():
+    with bot.get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT EXISTS (SELECT 1 FROM chat_logs_legacy)")
+            if cur.fetchone()[0]:
+                raise SystemExit("В chat_logs_legacy ещё остались строки, сначала завершите перенос.")
+            cur.execute("""
+                CREATE OR REPLACE VIEW chat_logs AS
+                    SELECT m.log_id, s.session_id, m.timestamp, m.sender_id, m.partner_id, m.message_id, t.name AS message_type,
+                           m.message_text, f.file_id, m.message_tsv
+                    FROM chat_messages m
+                    JOIN chat_sessions s ON s.session_key = m.session_key
+                    JOIN message_types t ON t.type_id = m.message_type
+                    LEFT JOIN media_files f ON f.media_id = m.media_id
+            """)
+            # Пустая таблица остаётся: на неё ссылается очистка истории в боте
+    logger.info("Представление chat_logs больше не читает chat_logs_legacy.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Перенос истории чатов в компактный формат без остановки бота.")
+    parser.add_argument("--batch-size", type=int, default=5000, help="строк за одну транзакцию")
+    parser.add_argument("--sleep", type=float, default=0.2, help="пауза между пачками, с")
+    parser.add_argument("--finalize", action="store_true", help="после переноса убрать legacy из представления chat_logs")
+    args = parser.parse_args()
+
+    bot.initialize_databases()
+    if args.finalize:
+        finalize()
+        return
+
+    total, last_log_id, started = 0, 0, time.monotonic()
+    while True:
+        moved, last_log_id = backfill_batch(last_log_id, args.batch_size)
+        if not moved: break
+        total += moved
+        logger.info("Перенесено %s строк (последний log_id %s, %.0f строк/с)", total, last_log_id, total / (time.monotonic() - started))
+        time.sleep(args.sleep)
+    logger.info("Перенос завершён: %s строк. Запустите с --finalize, чтобы отключить legacy-таблицу.", total)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,407 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import time
+from collections import Counter, defaultdict
+from email.parser import BytesParser
+from email.policy import default as email_policy
+from urllib.parse import parse_qs
+
+import psycopg2
+import psycopg2.extensions
+
+# Нагрузочный тест: настоящий Application из anonymous_chat_bot.build_application() работает
+# против локального фейкового Bot API (этот файл) и локального PostgreSQL.
+#
+#   DATABASE_URL=postgres://localhost/bench python load_test.py --pairs 50 --messages 30
+#
+# Результат: p50/p99 задержки пересылки, сообщений/сек и запросов к БД на один апдейт.
+
+BENCH_TOKEN = "123456:BENCH-TOKEN"
+BENCH_BOT = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+             "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+MARKER_RE = re.compile(r"bench:(\d+)")
+SEND_METHODS = {"sendMessage", "sendPhoto", "sendSticker", "sendVoice", "sendVideo", "sendVideoNote", "sendDocument",
+                "sendAudio", "sendMediaGroup", "copyMessage", "editMessageText", "editMessageCaption"}
+MESSAGE_KINDS = ["text", "photo", "album", "sticker", "voice", "reply", "edit"]
+MESSAGE_WEIGHTS = [50, 12, 3, 10, 10, 10, 5]
+ALBUM_SIZE = 4
+
+MATCHED_TEXT = "Суразмоўца знойдзены"
+PARTNER_LEFT_TEXTS = ("Суразмоўца завяршыў чат", "Суразмоўца пакінуў чат", "Не атрымалася даставіць")
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def parse_value(value: str):
+    try:
+        return json.loads(value)
+    except (ValueError, TypeError):
+        return value
+
+
+# --- СЧЁТЧИК ЗАПРОСОВ К БД ---
+
+class QueryCounter:
+    def __init__(self):
+        self.queries = 0
+        self.connections = 0
+
+
+class _CountingCursor:
+    def __init__(self, cursor, counter: QueryCounter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, *args, **kwargs):
+        self._counter.queries += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._counter.queries += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._cursor.__exit__(*exc)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def make_counting_connection_factory(counter: QueryCounter):
+    class CountingConnection(psycopg2.extensions.connection):
+        def cursor(self, *args, **kwargs):
+            return _CountingCursor(super().cursor(*args, **kwargs), counter)
+
+    def connect(dsn: str):
+        counter.connections += 1
+        return psycopg2.connect(dsn, connection_factory=CountingConnection)
+    return connect
+
+
+# --- ФЕЙКОВЫЙ BOT API ---
+
+class FakeBotAPI:
+    def __init__(self, forbidden_rate: float = 0.0, retry_after_rate: float = 0.0, seed: int | None = None):
+        self.forbidden_rate = forbidden_rate
+        self.retry_after_rate = retry_after_rate
+        self.random = random.Random(seed)
+        self.user_ids: set[int] = set()
+        self.updates: list[dict] = []
+        self.update_ids = itertools.count(1)
+        self.updates_delivered = 0
+        self.new_update = asyncio.Event()
+        self.message_ids = itertools.count(10_000_000)
+        self.calls = Counter()
+        self.injected_errors = Counter()
+        self.inbox: dict[int, list[dict]] = defaultdict(list)
+        self.inbox_events: dict[int, asyncio.Event] = defaultdict(asyncio.Event)
+        self.markers = itertools.count(1)
+        self.pending_markers: dict[int, tuple[float, int, str]] = {}
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.server: asyncio.AbstractServer | None = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self.server = await asyncio.start_server(self._handle_connection, host, port)
+        port = self.server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}/bot"
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while request_line := await reader.readline():
+                _, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, value = line.decode("latin-1").split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                params = self._parse_params(headers.get("content-type", ""), body)
+                status, payload = await self.dispatch(path.rsplit("/", 1)[-1], params)
+                data = json.dumps(payload).encode()
+                writer.write(f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse_params(content_type: str, body: bytes) -> dict:
+        if content_type.startswith("multipart/form-data"):
+            message = BytesParser(policy=email_policy).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+            raw = {part.get_param("name", header="content-disposition"): part.get_content()
+                   for part in message.iter_parts() if not part.get_filename()}
+        else:
+            raw = {key: values[0] for key, values in parse_qs(body.decode(), keep_blank_values=True).items()}
+        return {key: parse_value(value) for key, value in raw.items()}
+
+    # Апдейты для бота
+
+    def push_update(self, **payload):
+        self.updates.append({"update_id": next(self.update_ids), **payload})
+        self.new_update.set()
+
+    def new_marker(self, chat_id: int, kind: str) -> str:
+        marker = next(self.markers)
+        self.pending_markers[marker] = (time.perf_counter(), chat_id, kind)
+        return f"bench:{marker}"
+
+    async def _get_updates(self, params: dict) -> list[dict]:
+        offset = params.get("offset") or 0
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates:
+            self.new_update.clear()
+            try:
+                await asyncio.wait_for(self.new_update.wait(), timeout=min(float(params.get("timeout") or 0), 5.0))
+            except asyncio.TimeoutError:
+                pass
+        batch = self.updates[:int(params.get("limit") or 100)]
+        self.updates_delivered += len(batch)
+        return batch
+
+    # Обработка вызовов Bot API
+
+    async def dispatch(self, method: str, params: dict) -> tuple[int, dict]:
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": await self._get_updates(params)}
+        if method == "getMe":
+            return 200, {"ok": True, "result": BENCH_BOT}
+        if method not in SEND_METHODS:
+            return 200, {"ok": True, "result": True}
+
+        chat_id = int(params.get("chat_id", 0))
+        if chat_id in self.user_ids:
+            roll = self.random.random()
+            if roll < self.forbidden_rate:
+                self.injected_errors["Forbidden"] += 1
+                return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+            if roll < self.forbidden_rate + self.retry_after_rate:
+                self.injected_errors["RetryAfter"] += 1
+                return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                             "parameters": {"retry_after": 1}}
+
+        self._record_delivery(chat_id, params)
+        if method == "copyMessage":
+            return 200, {"ok": True, "result": {"message_id": next(self.message_ids)}}
+        if method == "sendMediaGroup":
+            return 200, {"ok": True, "result": [self._make_sent_message(chat_id, {}) for _ in params.get("media", [])]}
+        if method.startswith("edit"):
+            return 200, {"ok": True, "result": self._make_sent_message(chat_id, params, params.get("message_id"))}
+        message = self._make_sent_message(chat_id, params)
+        self.inbox[chat_id].append(message)
+        self.inbox_events[chat_id].set()
+        return 200, {"ok": True, "result": message}
+
+    def _record_delivery(self, chat_id: int, params: dict):
+        now = time.perf_counter()
+        for match in MARKER_RE.finditer(json.dumps(params, ensure_ascii=False)):
+            pending = self.pending_markers.get(int(match.group(1)))
+            if pending and pending[1] != chat_id:
+                del self.pending_markers[int(match.group(1))]
+                self.latencies[pending[2]].append(now - pending[0])
+
+    def _make_sent_message(self, chat_id: int, params: dict, message_id: int | None = None) -> dict:
+        message = {"message_id": message_id or next(self.message_ids), "date": int(time.time()), "from": BENCH_BOT,
+                   "chat": {"id": chat_id, "type": "private", "first_name": "User"}}
+        if isinstance(params.get("text"), str): message["text"] = params["text"]
+        if isinstance(params.get("caption"), str): message["caption"] = params["caption"]
+        return message
+
+    async def wait_for_text(self, chat_id: int, needles: tuple[str, ...], start: int, timeout: float) -> int | None:
+        deadline = time.perf_counter() + timeout
+        while True:
+            inbox = self.inbox[chat_id]
+            for index in range(start, len(inbox)):
+                if any(needle in inbox[index].get("text", "") for needle in needles):
+                    return index
+            start = len(inbox)
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0: return None
+            event = self.inbox_events[chat_id]
+            event.clear()
+            try:
+                await asyncio.wait_for(event.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                return None
+
+
+# --- СИМУЛЯЦИЯ ПОЛЬЗОВАТЕЛЕЙ ---
+
+class SimulatedUser:
+    def __init__(self, api: FakeBotAPI, user_id: int, rng: random.Random):
+        self.api = api
+        self.user_id = user_id
+        self.rng = rng
+        self.message_ids = itertools.count(1)
+        self.sent_texts: list[int] = []
+        api.user_ids.add(user_id)
+
+    def _message(self, message_id: int | None = None, **fields) -> dict:
+        user = {"id": self.user_id, "is_bot": False, "first_name": f"Bench{self.user_id}"}
+        return {"message_id": message_id or next(self.message_ids), "date": int(time.time()),
+                "chat": {"id": self.user_id, "type": "private", "first_name": user["first_name"]}, "from": user, **fields}
+
+    def command(self, name: str):
+        text = f"/{name}"
+        self.api.push_update(message=self._message(text=text, entities=[{"type": "bot_command", "offset": 0, "length": len(text)}]))
+
+    def send_random(self):
+        kind = self.rng.choices(MESSAGE_KINDS, MESSAGE_WEIGHTS)[0]
+        received = [m for m in self.api.inbox[self.user_id] if "bench:" in json.dumps(m)]
+        if kind == "reply" and not received: kind = "text"
+        if kind == "edit" and not self.sent_texts: kind = "text"
+        marker = self.api.new_marker(self.user_id, kind)
+        unique = f"{self.user_id}-{marker}"
+        if kind == "text":
+            message = self._message(text=f"Прывітаньне {marker}")
+            self.sent_texts.append(message["message_id"])
+        elif kind == "photo":
+            message = self._message(caption=f"Фота {marker}", photo=[{"file_id": f"photo-{unique}", "file_unique_id": f"u-photo-{unique}", "width": 90, "height": 90}])
+        elif kind == "album":
+            media_group_id = f"album-{unique}"
+            for i in range(ALBUM_SIZE):
+                self.api.push_update(message=self._message(
+                    media_group_id=media_group_id, caption=f"Альбом {marker}" if i == 0 else None,
+                    photo=[{"file_id": f"photo-{unique}-{i}", "file_unique_id": f"u-photo-{unique}-{i}", "width": 90, "height": 90}]))
+            return
+        elif kind == "sticker":
+            message = self._message(sticker={"file_id": f"sticker-{unique}", "file_unique_id": f"u-sticker-{unique}", "type": "regular",
+                                             "width": 512, "height": 512, "is_animated": False, "is_video": False})
+        elif kind == "voice":
+            message = self._message(voice={"file_id": f"voice-{unique}", "file_unique_id": f"u-voice-{unique}", "duration": 2})
+        elif kind == "reply":
+            target = self.rng.choice(received[-20:])
+            message = self._message(text=f"Адказ {marker}", reply_to_message={
+                "message_id": target["message_id"], "date": target["date"], "chat": {"id": self.user_id, "type": "private", "first_name": "User"}})
+        else:
+            message = self._message(message_id=self.rng.choice(self.sent_texts[-10:]), text=f"Выпраўлена {marker}", edit_date=int(time.time()))
+            self.api.push_update(edited_message=message)
+            return
+        self.api.push_update(message=message)
+
+    async def run(self, messages: int, think_time: float, match_timeout: float):
+        self.command("search")
+        matched_at = await self.api.wait_for_text(self.user_id, (MATCHED_TEXT,), 0, match_timeout)
+        if matched_at is None:
+            self.command("stop")
+            return False
+        for _ in range(messages):
+            await asyncio.sleep(self.rng.expovariate(1 / think_time) if think_time > 0 else 0)
+            if await self.api.wait_for_text(self.user_id, PARTNER_LEFT_TEXTS, matched_at + 1, 0) is not None:
+                return True
+            self.send_random()
+        self.command("stop")
+        return True
+
+
+# --- ЗАПУСК ---
+
+async def run_benchmark(args) -> dict:
+    import anonymous_chat_bot as bot
+
+    counter = QueryCounter()
+    bot.get_db_connection = lambda connect=make_counting_connection_factory(counter): connect(bot.DATABASE_URL)
+    bot.initialize_databases()
+
+    api = FakeBotAPI(forbidden_rate=args.forbidden_rate, retry_after_rate=args.retry_after_rate, seed=args.seed)
+    base_url = await api.start()
+    application = bot.build_application(token=BENCH_TOKEN, base_url=base_url)
+    rng = random.Random(args.seed)
+    base_id = args.user_id_base or 7_000_000_000 + int(time.time()) % 1_000_000 * 1000
+    users = [SimulatedUser(api, base_id + i, random.Random(rng.random())) for i in range(args.pairs * 2)]
+
+    async with application:
+        await bot.post_init(application)
+        await application.start()
+        await application.updater.start_polling(poll_interval=0.0, timeout=1)
+        queries_before, updates_before = counter.queries, api.updates_delivered
+        started = time.perf_counter()
+        results = await asyncio.gather(*(u.run(args.messages, args.think_time, args.match_timeout) for u in users))
+        # Ждём, пока бот разберёт хвост очереди апдейтов
+        while api.updates or application.update_queue.qsize():
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(args.drain_time)
+        elapsed = time.perf_counter() - started
+        queries, updates = counter.queries - queries_before, api.updates_delivered - updates_before
+        await application.updater.stop()
+        await application.stop()
+    await api.stop()
+
+    relay = [latency for kind, values in api.latencies.items() if kind != "edit" for latency in values]
+    return {
+        "pairs": args.pairs, "matched_users": sum(results), "elapsed_sec": round(elapsed, 3),
+        "updates": updates, "updates_per_sec": round(updates / elapsed, 1),
+        "relayed_messages": len(relay), "messages_per_sec": round(len(relay) / elapsed, 1),
+        "relay_latency_ms": {"p50": round(percentile(relay, 50) * 1000, 2), "p99": round(percentile(relay, 99) * 1000, 2)},
+        "latency_by_kind_ms": {kind: {"count": len(values), "p50": round(percentile(values, 50) * 1000, 2), "p99": round(percentile(values, 99) * 1000, 2)}
+                               for kind, values in sorted(api.latencies.items())},
+        "undelivered_markers": len(api.pending_markers),
+        "db_queries": queries, "db_queries_per_update": round(queries / updates, 2) if updates else 0.0,
+        "db_connections": counter.connections,
+        "api_calls": dict(api.calls.most_common()), "injected_errors": dict(api.injected_errors),
+    }
+
+
+def print_report(report: dict):
+    print(f"Пар: {report['pairs']}, сматчено пользователей: {report['matched_users']}, время: {report['elapsed_sec']} c")
+    print(f"Апдейтов: {report['updates']} ({report['updates_per_sec']}/c), переслано: {report['relayed_messages']} ({report['messages_per_sec']}/c)")
+    print(f"Задержка пересылки: p50 {report['relay_latency_ms']['p50']} мс, p99 {report['relay_latency_ms']['p99']} мс")
+    for kind, stats in report["latency_by_kind_ms"].items():
+        print(f"  {kind:<8} n={stats['count']:<6} p50 {stats['p50']} мс, p99 {stats['p99']} мс")
+    print(f"Запросов к БД: {report['db_queries']} ({report['db_queries_per_update']} на апдейт), соединений: {report['db_connections']}")
+    print(f"Не доставлено: {report['undelivered_markers']}, внедрённые ошибки: {report['injected_errors'] or 'нет'}")
+    print(f"Вызовы Bot API: {report['api_calls']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота против фейкового Bot API и локального PostgreSQL.")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL"), help="DSN локальной тестовой БД (по умолчанию DATABASE_URL)")
+    parser.add_argument("--pairs", type=int, default=20, help="число пар пользователей")
+    parser.add_argument("--messages", type=int, default=30, help="сообщений на пользователя")
+    parser.add_argument("--think-time", type=float, default=0.05, help="средняя пауза между сообщениями, с")
+    parser.add_argument("--match-timeout", type=float, default=30.0, help="сколько ждать собеседника, с")
+    parser.add_argument("--drain-time", type=float, default=1.0, help="пауза на дообработку после сценария, с")
+    parser.add_argument("--forbidden-rate", type=float, default=0.0, help="доля отправок, отвечающих Forbidden")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="доля отправок, отвечающих RetryAfter")
+    parser.add_argument("--user-id-base", type=int, default=0, help="первый ID симулируемых пользователей")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", dest="json_path", help="записать отчёт в JSON-файл")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.database_url:
+        sys.exit("Укажите --database-url или DATABASE_URL с локальной тестовой БД.")
+    os.environ["DATABASE_URL"] = args.database_url
+    report = asyncio.run(run_benchmark(args))
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()